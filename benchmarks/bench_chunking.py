@@ -0,0 +1,129 @@
+#!/ffp/bin/python
+
+"""
+Compares uploading a large file whole with uploading it as content defined
+chunks after a small part of it changed.
+
+Run cmd:
+/ffp/bin/python benchmarks/bench_chunking.py --dir /mnt/HD_a2/tmp --size 10737418240 --change 0.01
+
+The uplink is not used; bytes sent are the bytes idevsutil would be given
+and the upload time is estimated from --uplink-kbps.
+"""
+
+import os
+import sys
+import random
+import shutil
+import argparse
+import tempfile
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from idrive_chunks import ChunkIndex, chunk_file, write_manifest, clear_outbox
+
+__author__ = 'kpiwk'
+
+
+def _write_random_file(path, size, block_size=4 * 1024 * 1024):
+    with open(path, 'wb') as out:
+        written = 0
+        while written < size:
+            block = os.urandom(min(block_size, size - written))
+            out.write(block)
+            written += len(block)
+
+
+def _change_randomly(path, size, ratio, block_size, seed):
+    """
+    Overwrites random blocks until ratio * size bytes changed.
+
+    :return: Number of blocks written
+    """
+    rnd = random.Random(seed)
+    changed = 0
+    blocks = 0
+    with open(path, 'r+b') as out:
+        while changed < size * ratio:
+            out.seek(rnd.randrange(0, max(size - block_size, 1)))
+            out.write(os.urandom(block_size))
+            changed += block_size
+            blocks += 1
+    return blocks
+
+
+def _chunk_pass(path, index, outbox):
+    start = timer()
+    manifest, new_chunks = chunk_file(path, index, outbox)
+    manifest_size = os.path.getsize(os.path.join(outbox, write_manifest(outbox, manifest).lstrip('/')))
+    index.add(new_chunks.items())
+    clear_outbox(outbox)
+    return timer() - start, sum(new_chunks.values()) + manifest_size, len(manifest['chunks'])
+
+
+def _read_pass(path):
+    start = timer()
+    with open(path, 'rb') as stream:
+        while stream.read(4 * 1024 * 1024):
+            pass
+    return timer() - start
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dir', help='Folder for the test file.', type=str, default=tempfile.gettempdir())
+    parser.add_argument('--size', help='Test file size in bytes.', type=int, default=10 * 1024 ** 3)
+    parser.add_argument('--change', help='Ratio of the file to overwrite.', type=float, default=0.01)
+    parser.add_argument('--block', help='Size of one random write in bytes.', type=int, default=64 * 1024)
+    parser.add_argument('--uplink-kbps', help='Uplink speed used to estimate upload time.', type=float,
+                        default=1024.0)
+    parser.add_argument('--seed', help='Random seed for the changes.', type=int, default=1)
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    def main():
+        """
+        This is the main function.
+
+        :return:
+        """
+
+        args = _parse_args()
+        work = tempfile.mkdtemp(prefix='bench-chunking-', dir=args.dir)
+        try:
+            path = os.path.join(work, 'disk.img')
+            index = ChunkIndex(os.path.join(work, 'chunks.db'))
+            outbox = os.path.join(work, 'outbox')
+
+            print "Writing {} bytes of random data...".format(args.size)
+            _write_random_file(path, args.size)
+
+            first_time, first_bytes, chunks = _chunk_pass(path, index, outbox)
+            print "Initial chunking: {} chunks, {:.1f} s ({:.1f} MB/s)".format(
+                chunks, first_time, args.size / first_time / 1024 ** 2)
+
+            blocks = _change_randomly(path, args.size, args.change, args.block, args.seed)
+            print "Changed {:.2%} of the file in {} random writes of {} bytes".format(args.change, blocks,
+                                                                                       args.block)
+
+            read_time = _read_pass(path)
+            delta_time, delta_bytes, chunks = _chunk_pass(path, index, outbox)
+            uplink = args.uplink_kbps * 1024
+
+            print ""
+            print "{:<10} {:>16} {:>14} {:>18}".format('mode', 'bytes sent', 'local time s', 'est. total time s')
+            print "{:<10} {:>16} {:>14.1f} {:>18.1f}".format('whole', args.size, read_time,
+                                                            read_time + args.size / uplink)
+            print "{:<10} {:>16} {:>14.1f} {:>18.1f}".format('chunked', delta_bytes, delta_time,
+                                                            delta_time + delta_bytes / uplink)
+            print ""
+            print "Chunked upload sends {:.2%} of the file.".format(float(delta_bytes) / args.size)
+            index.close()
+        finally:
+            shutil.rmtree(work, ignore_errors=True)
+
+
+    main()
@@ -0,0 +1,134 @@
+#!/ffp/bin/python
+
+"""
+Compares the read throughput of an upload list in written order with the
+same list in upload queue order (as built for run_backup), where the files
+of a priority tier come in disk order.
+
+Needs root: it creates an ext4 image, loop mounts it and drops the page
+cache before every pass.
+
+Run cmd:
+/ffp/bin/python benchmarks/bench_locality.py --dir /mnt/HD_a2/tmp --files 5000 --dirs 50
+"""
+
+import os
+import sys
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from idrive_uploads import UPLOAD_BATCH_SIZE, _first_block, _build_upload_queue, _pop_batch
+
+__author__ = 'kpiwk'
+
+
+def _drop_caches():
+    subprocess.check_call(['sync'])
+    with open('/proc/sys/vm/drop_caches', 'w') as drop:
+        drop.write('3\n')
+
+
+def _populate(mount_path, num_files, num_dirs, min_size, max_size, seed):
+    """
+    Writes files round robin across the folders, the way new photos or
+    documents arrive in several folders at once.
+
+    :return: List of file paths in written order
+    """
+    rnd = random.Random(seed)
+    dirs = [os.path.join(mount_path, 'dir{:03d}'.format(index)) for index in range(num_dirs)]
+    for dir_path in dirs:
+        os.makedirs(dir_path)
+
+    paths = []
+    for index in range(num_files):
+        path = os.path.join(dirs[index % num_dirs], 'file{:06d}'.format(index))
+        with open(path, 'wb') as out:
+            out.write(os.urandom(rnd.randint(min_size, max_size)))
+        paths.append(path)
+    return paths
+
+
+def _read_pass(paths):
+    _drop_caches()
+    total = 0
+    start = timer()
+    for path in paths:
+        with open(path, 'rb') as stream:
+            while True:
+                block = stream.read(1024 * 1024)
+                if not block:
+                    break
+                total += len(block)
+    return total, timer() - start
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dir', help='Folder for the image and mount point.', type=str,
+                        default=tempfile.gettempdir())
+    parser.add_argument('--image-size', help='Size of the ext4 image in MB.', type=int, default=2048)
+    parser.add_argument('--files', help='Number of files.', type=int, default=5000)
+    parser.add_argument('--dirs', help='Number of folders the files are spread over.', type=int, default=50)
+    parser.add_argument('--min-size', help='Minimum file size in bytes.', type=int, default=4 * 1024)
+    parser.add_argument('--max-size', help='Maximum file size in bytes.', type=int, default=256 * 1024)
+    parser.add_argument('--rounds', help='Read passes per order.', type=int, default=3)
+    parser.add_argument('--seed', help='Random seed.', type=int, default=1)
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    def main():
+        """
+        This is the main function.
+
+        :return:
+        """
+
+        args = _parse_args()
+        work = tempfile.mkdtemp(prefix='bench-locality-', dir=args.dir)
+        image = os.path.join(work, 'ext4.img')
+        mount_path = os.path.join(work, 'mnt')
+        os.makedirs(mount_path)
+        mounted = False
+        try:
+            with open(image, 'wb') as image_file:
+                image_file.truncate(args.image_size * 1024 * 1024)
+            subprocess.check_call(['mkfs.ext4', '-F', '-q', image])
+            subprocess.check_call(['mount', '-o', 'loop', image, mount_path])
+            mounted = True
+
+            written = _populate(mount_path, args.files, args.dirs, args.min_size, args.max_size, args.seed)
+
+            # Write back first, delayed allocation leaves fresh files without a physical block
+            subprocess.check_call(['sync'])
+            start = timer()
+            upload_queue = _build_upload_queue((path, os.path.getsize(path), os.path.getmtime(path), mount_path)
+                                               for path in written)
+            ordered = []
+            while upload_queue:
+                ordered.extend(path for _, path, _, _ in _pop_batch(upload_queue, UPLOAD_BATCH_SIZE))
+            sort_time = timer() - start
+            mapped = sum(1 for path in written if _first_block(path) is not None)
+            print "Queued {} files in {:.2f} s, {} located by FIEMAP/FIBMAP".format(len(written), sort_time, mapped)
+
+            print "{:<10} {:>6} {:>14} {:>10} {:>10}".format('order', 'round', 'bytes', 'seconds', 'MB/s')
+            for name, paths in (('written', written), ('queue', ordered)):
+                for round_no in range(args.rounds):
+                    total, seconds = _read_pass(paths)
+                    print "{:<10} {:>6} {:>14} {:>10.2f} {:>10.1f}".format(name, round_no + 1, total, seconds,
+                                                                          total / seconds / 1024 ** 2)
+        finally:
+            if mounted:
+                subprocess.call(['umount', mount_path])
+            shutil.rmtree(work, ignore_errors=True)
+
+
+    main()
@@ -0,0 +1,137 @@
+#!/ffp/bin/python
+
+"""
+Compares the sequential scan-then-upload cycle with the pipelined one,
+where batches start while the backup roots are still being scanned.
+
+Run cmd:
+/ffp/bin/python benchmarks/bench_pipeline.py --dir /mnt/HD_a2/tmp --files 20000 --dirs 200
+
+idevsutil is replaced by a script that sleeps for the time the batch would
+take on an uplink of --uplink-kbps plus --batch-overhead seconds, and
+prints the xml items idevsutil would. --scan-delay-ms adds a delay per
+scanned file to model a cold cache on the NAS disks; with --drop-caches
+(needs root) the page cache is dropped before every cycle instead.
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import logging
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from idrive_transfer import TransferTuner
+from idrive_uploads import UPLOAD_BATCH_SIZE, _scan_backup_roots, _upload_changes
+
+__author__ = 'kpiwk'
+
+
+_FAKE_IDEVSUTIL = """
+import os
+import sys
+import time
+
+file_list, rate, overhead = sys.argv[1], float(sys.argv[2]), float(sys.argv[3])
+with open(file_list, 'rb') as list_file:
+    paths = [path for path in list_file.read().split(b'\\0') if path]
+sizes = [os.path.getsize(path) for path in paths]
+time.sleep(overhead + sum(sizes) / rate)
+for path, size in zip(paths, sizes):
+    sys.stdout.write('<item size="{}" per="100%" trf_type="FULL" fname="{}"/>\\n'.format(size, path.decode()))
+"""
+
+
+def _drop_caches():
+    subprocess.check_call(['sync'])
+    with open('/proc/sys/vm/drop_caches', 'w') as drop:
+        drop.write('3\n')
+
+
+def _populate(root, num_files, num_dirs, min_size, max_size, seed):
+    rnd = random.Random(seed)
+    for index in range(num_files):
+        dir_path = os.path.join(root, 'dir{:04d}'.format(index % num_dirs))
+        if not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+        with open(os.path.join(dir_path, 'file{:07d}'.format(index)), 'wb') as out:
+            out.write(os.urandom(rnd.randint(min_size, max_size)))
+
+
+def _slow_scan(files, delay):
+    for changed in files:
+        time.sleep(delay)
+        yield changed
+
+
+def _cycle(cmd, root, list_path, log, pipeline, scan_delay, drop_caches):
+    if drop_caches:
+        _drop_caches()
+    files = _scan_backup_roots([root.lstrip('/')])
+    if scan_delay:
+        files = _slow_scan(files, scan_delay)
+    start = time.time()
+    ret_code, _, _, first_upload = _upload_changes(cmd=cmd, files=files, list_path=list_path,
+                                                   tuner=TransferTuner(batch_size=UPLOAD_BATCH_SIZE), log=log,
+                                                   pipeline=pipeline)
+    return ret_code, first_upload - start, time.time() - start
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dir', help='Folder for the test tree.', type=str, default=tempfile.gettempdir())
+    parser.add_argument('--files', help='Number of changed files.', type=int, default=20000)
+    parser.add_argument('--dirs', help='Number of folders the files are spread over.', type=int, default=200)
+    parser.add_argument('--min-size', help='Minimum file size in bytes.', type=int, default=1024)
+    parser.add_argument('--max-size', help='Maximum file size in bytes.', type=int, default=64 * 1024)
+    parser.add_argument('--uplink-kbps', help='Simulated uplink speed.', type=float, default=8192.0)
+    parser.add_argument('--batch-overhead', help='Simulated seconds per idevsutil run.', type=float, default=1.0)
+    parser.add_argument('--scan-delay-ms', help='Added delay per scanned file.', type=float, default=0.5)
+    parser.add_argument('--drop-caches', help='Drop the page cache before every cycle.', action='store_true')
+    parser.add_argument('--rounds', help='Cycles per mode.', type=int, default=2)
+    parser.add_argument('--seed', help='Random seed.', type=int, default=1)
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    def main():
+        """
+        This is the main function.
+
+        :return:
+        """
+
+        args = _parse_args()
+        work = tempfile.mkdtemp(prefix='bench-pipeline-', dir=args.dir)
+        log = logging.getLogger('bench_pipeline')
+        log.addHandler(logging.NullHandler())
+        try:
+            root = os.path.join(work, 'tree')
+            fake = os.path.join(work, 'idevsutil.py')
+            with open(fake, 'w') as fake_file:
+                fake_file.write(_FAKE_IDEVSUTIL)
+            cmd = '{} {} {{file_list}} {} {}'.format(sys.executable, fake, args.uplink_kbps * 1024,
+                                                    args.batch_overhead)
+
+            print "Writing {} files...".format(args.files)
+            _populate(root, args.files, args.dirs, args.min_size, args.max_size, args.seed)
+
+            print "{:<12} {:>6} {:>4} {:>22} {:>16}".format('mode', 'round', 'rc', 'time to first upload s',
+                                                           'cycle time s')
+            for name, pipeline in (('sequential', False), ('pipelined', True)):
+                for round_no in range(args.rounds):
+                    ret_code, first_upload, total = _cycle(cmd, root, os.path.join(work, 'tmp'), log, pipeline,
+                                                           args.scan_delay_ms / 1000.0, args.drop_caches)
+                    print "{:<12} {:>6} {:>4} {:>22.2f} {:>16.2f}".format(name, round_no + 1, ret_code,
+                                                                         first_upload, total)
+        finally:
+            shutil.rmtree(work, ignore_errors=True)
+
+
+    main()
@@ -0,0 +1,316 @@
+"""
+Content defined chunking of large files.
+
+Large files are split into chunks at content defined cut points, so an
+edit only changes the chunks around it. Chunks are stored on the server
+by their SHA-1 below CHUNK_DIR together with a small manifest per file
+listing its chunks in order.
+
+Cut points: a position is a candidate when its byte is one of a few
+marker values (found by the regex engine at C speed); a candidate is a cut
+point when the CRC32 of the CHUNK_WINDOW bytes ending there has its low
+CHUNK_MASK bits clear. Both tests only look at the bytes around the
+position, so cut points move along with inserted or removed data.
+"""
+
+import os
+import re
+import json
+import zlib
+import time
+import errno
+import shutil
+import sqlite3
+import hashlib
+import collections
+
+__author__ = 'kpiwk'
+
+
+# Chunk size limits; the average is about CHUNK_MIN_SIZE + 64 * (CHUNK_MASK + 1)
+CHUNK_MIN_SIZE = 256 * 1024
+CHUNK_MAX_SIZE = 4 * 1024 * 1024
+CHUNK_MASK = (1 << 13) - 1
+CHUNK_WINDOW = 48
+
+# Server folder (below the backup destination) holding chunks and manifests
+CHUNK_DIR = '.idrive_chunks'
+
+_CANDIDATE_RE = re.compile(b'[\x1b\x6b\x93\xd7]')
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as exc:  # Python >2.5
+        if exc.errno == errno.EEXIST and os.path.isdir(path):
+            pass
+        else:
+            raise
+
+
+def _cut_point(data, start):
+    """
+    Finds the end of the chunk starting at the given offset.
+
+    :param data: Buffer holding at least CHUNK_MAX_SIZE bytes from start unless at the end of file
+    :param start: Chunk start offset in data
+    :return: Chunk end offset in data
+    """
+    end = min(len(data), start + CHUNK_MAX_SIZE)
+    if end - start <= CHUNK_MIN_SIZE:
+        return end
+    for match in _CANDIDATE_RE.finditer(data, start + CHUNK_MIN_SIZE, end):
+        position = match.end()
+        if not zlib.crc32(data[position - CHUNK_WINDOW:position]) & CHUNK_MASK:
+            return position
+    return end
+
+
+def iter_chunks(stream):
+    """
+    Splits a file into content defined chunks.
+
+    :param stream: File object opened in binary mode
+    :return: Generator of chunk data
+    """
+    data = b''
+    start = 0
+    eof = False
+    while True:
+        if not eof and len(data) - start < CHUNK_MAX_SIZE:
+            block = stream.read(CHUNK_MAX_SIZE)
+            data = data[start:] + block
+            start = 0
+            eof = not block
+            continue
+        if start >= len(data):
+            return
+        end = _cut_point(data, start)
+        yield data[start:end]
+        start = end
+
+
+def chunk_hash(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def chunk_entry(digest):
+    """
+    Builds the files-from entry of a chunk, relative to the chunk root.
+
+    :param digest: Chunk SHA-1
+    :return: Entry starting with /
+    """
+    return '/{}/data/{}/{}'.format(CHUNK_DIR, digest[:2], digest)
+
+
+def manifest_entry(path):
+    """
+    Builds the files-from entry of the manifest of a file.
+
+    :param path: Full path of the chunked file
+    :return: Entry starting with /
+    """
+    return '/{}/manifests/{}.manifest'.format(CHUNK_DIR, path.lstrip('/'))
+
+
+def is_manifest_entry(entry):
+    return entry.lstrip('/').startswith('{}/manifests/'.format(CHUNK_DIR)) and entry.endswith('.manifest')
+
+
+def is_chunk_entry(entry):
+    return entry.lstrip('/').startswith('{}/data/'.format(CHUNK_DIR))
+
+
+def read_manifest(path):
+    with open(path) as manifest_file:
+        return json.load(manifest_file)
+
+
+def write_manifest(root, manifest):
+    """
+    Writes a manifest below the chunk root.
+
+    :param root: Local folder mirroring the server chunk root
+    :param manifest: Manifest dict with path, size, mtime and chunks
+    :return: files-from entry of the manifest
+    """
+    entry = manifest_entry(manifest['path'])
+    manifest_path = os.path.join(root, entry.lstrip('/'))
+    _makedirs(os.path.dirname(manifest_path))
+    with open(manifest_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+    return entry
+
+
+class ChunkIndex(object):
+    """
+    Local index of the chunks already stored on the server.
+    """
+
+    def __init__(self, db_path):
+        _makedirs(os.path.dirname(db_path))
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS chunks (hash TEXT PRIMARY KEY, size INTEGER, uploaded REAL)')
+        self.conn.commit()
+
+    def __contains__(self, digest):
+        return self.conn.execute('SELECT 1 FROM chunks WHERE hash = ?', (digest,)).fetchone() is not None
+
+    def add(self, chunks):
+        """
+        Marks chunks as stored on the server.
+
+        :param chunks: Iterable of (hash, size) tuples
+        :return:
+        """
+        now = time.time()
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO chunks (hash, size, uploaded) VALUES (?, ?, ?)',
+                                  [(digest, size, now) for digest, size in chunks])
+
+    def close(self):
+        self.conn.close()
+
+
+def chunk_file(path, index, outbox, written=None):
+    """
+    Chunks a file and writes the chunks missing on the server to the outbox.
+
+    :param path: Full path of the file
+    :param index: ChunkIndex instance
+    :param outbox: Local folder mirroring the server chunk root
+    :param written: (Optional) Callable(hash, size) invoked for every chunk written to the outbox; it may
+                    upload and clear the outbox
+    :return: Tuple of the manifest dict and a dict of new chunk hash to size
+    """
+    file_stat = os.stat(path)
+    chunks = []
+    new_chunks = dict()
+    with open(path, 'rb') as stream:
+        for data in iter_chunks(stream):
+            digest = chunk_hash(data)
+            chunks.append([digest, len(data)])
+            if digest in new_chunks or digest in index:
+                continue
+            chunk_path = os.path.join(outbox, chunk_entry(digest).lstrip('/'))
+            if not os.path.exists(chunk_path):
+                _makedirs(os.path.dirname(chunk_path))
+                with open(chunk_path + '.part', 'wb') as chunk_out:
+                    chunk_out.write(data)
+                os.rename(chunk_path + '.part', chunk_path)
+                if written is not None:
+                    written(digest, len(data))
+            new_chunks[digest] = len(data)
+
+    manifest = {'path': path,
+                'size': file_stat.st_size,
+                'mtime': file_stat.st_mtime,
+                'chunks': chunks}
+    return manifest, new_chunks
+
+
+def local_chunks(path):
+    """
+    Chunks an existing local copy of a file to reuse its unchanged chunks.
+
+    :param path: Full path of the local copy
+    :return: Dict of chunk hash to (offset, size)
+    """
+    found = dict()
+    if not os.path.isfile(path):
+        return found
+    offset = 0
+    with open(path, 'rb') as stream:
+        for data in iter_chunks(stream):
+            found.setdefault(chunk_hash(data), (offset, len(data)))
+            offset += len(data)
+    return found
+
+
+def _next_missing(chunks, reused, chunk_root, limit):
+    """
+    Lists the next chunks to download, up to limit bytes but at least one.
+
+    :param chunks: Remaining (hash, size) list of the manifest
+    :param reused: Hashes taken from the previous local copy
+    :param chunk_root: Local folder mirroring the server chunk root
+    :param limit: Maximum bytes to download at once
+    :return: List of chunk hashes
+    """
+    missing = []
+    total = 0
+    for digest, size in chunks:
+        if digest in reused or digest in missing \
+                or os.path.exists(os.path.join(chunk_root, chunk_entry(digest).lstrip('/'))):
+            continue
+        if missing and total + size > limit:
+            break
+        missing.append(digest)
+        total += size
+    return missing
+
+
+def assemble_file(manifest, dst, chunk_root, reuse=None, fetch=None, fetch_bytes=None):
+    """
+    Rebuilds a file from its manifest.
+
+    Chunks are taken from the previous local copy where possible and from
+    the downloaded chunk files otherwise. The file is written to a hidden
+    part file and renamed into place once complete.
+
+    With fetch, the chunks are downloaded while the file is written, up to
+    fetch_bytes at a time, and removed once the file needs them no more, so
+    the chunk root holds about fetch_bytes at most.
+
+    :param manifest: Manifest dict
+    :param dst: Full path of the rebuilt file
+    :param chunk_root: Local folder mirroring the server chunk root
+    :param reuse: (Optional) Dict from local_chunks for the previous copy of dst
+    :param fetch: (Optional) Callable downloading a list of chunk hashes into chunk_root
+    :param fetch_bytes: Maximum bytes passed to one fetch call
+    :return:
+    """
+    if reuse is None:
+        reuse = dict()
+    _makedirs(os.path.dirname(dst))
+    part = os.path.join(os.path.dirname(dst), '.{}.idrive-part'.format(os.path.basename(dst)))
+    previous = open(dst, 'rb') if reuse and os.path.isfile(dst) else None
+    reused = set(reuse) if previous is not None else set()
+    chunks = manifest['chunks']
+    remaining = collections.Counter(digest for digest, _ in chunks)
+    try:
+        with open(part, 'wb') as part_file:
+            for position, (digest, size) in enumerate(chunks):
+                remaining[digest] -= 1
+                if digest in reused:
+                    previous.seek(reuse[digest][0])
+                    data = previous.read(size)
+                else:
+                    chunk_path = os.path.join(chunk_root, chunk_entry(digest).lstrip('/'))
+                    if fetch is not None and not os.path.exists(chunk_path):
+                        fetch(_next_missing(chunks[position:], reused, chunk_root, fetch_bytes))
+                    with open(chunk_path, 'rb') as chunk_in:
+                        data = chunk_in.read()
+                    if fetch is not None and not remaining[digest]:
+                        os.remove(chunk_path)
+                if chunk_hash(data) != digest:
+                    raise IOError("Chunk {} of {} is corrupt".format(digest, manifest['path']))
+                part_file.write(data)
+            part_file.flush()
+            os.fsync(part_file.fileno())
+    except Exception:
+        if os.path.exists(part):
+            os.remove(part)
+        raise
+    finally:
+        if previous is not None:
+            previous.close()
+    os.utime(part, (manifest['mtime'], manifest['mtime']))
+    os.rename(part, dst)
+
+
+def clear_outbox(outbox):
+    shutil.rmtree(os.path.join(outbox, CHUNK_DIR), ignore_errors=True)
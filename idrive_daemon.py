@@ -3,8 +3,10 @@ import daemon.pidfile
 import signal
 
 import time
+import math
 import os
 import sys
+import threading
 from timeit import default_timer as timer
 
 import logging
@@ -13,6 +15,7 @@ import errno
 
 from idrive_uploads import run_backup
 from idrive_downloads import run_download
+from idrive_ledger import Ledger
 
 __author__ = 'kpiwk'
 
@@ -29,10 +32,33 @@ _user_name = 'pivul@o2.pl'
 _pwd_file = '/ffp/idrive/cfg/acc_pwd'
 _pvt_key = '/ffp/idrive/cfg/enc_key'
 _files_from = '/ffp/idrive/cfg/backup_list'
+_upload_weights = {}  # backup_list entry -> priority weight (default 1), e.g. {'/mnt/HD_a2/photo': 4}
+_chunk_threshold = None  # files from this size (bytes) on are uploaded as changed chunks only, e.g. 1073741824
+_upload_pipeline = True  # start uploading while the backup roots are still scanned; ranks against files scanned so far
 
 _source = 'MI\ 5_861322038690984'
 _target_path = '/mnt/HD_a2/photo/synced/Mi5'
 _download_from = '/ffp/idrive/cfg/download_list'
+_use_events = False  # download only files of new server events; full comparison when the cursor is lost or too old
+_staging_path = None  # e.g. '/tmp/idrive-staging' on tmpfs/SSD; None downloads straight to _target_path
+_staging_budget = 1073741824  # soft limit of _staging_path; downloads are held while over it and the mover is busy
+
+_ledger_db = '/ffp/idrive/cfg/ledger.db'  # run and file transfer history, query with idrive_ledger.py
+_ledger_retention = 365  # days of history kept in _ledger_db
+
+_governor_nice = 'ionice -c 2 -n 7 nice -n 19'  # prefix for idevsutil transfers; '' to disable
+_governor_bw_file = '/ffp/idrive/cfg/bw'  # --bw-file written by the governor
+_governor_bw_normal = 100  # bandwidth percentage without pressure
+_governor_bw_throttled = 25  # bandwidth percentage under moderate pressure
+_governor_thresholds = {  # metric: (throttle above, pause above)
+    'cpu': (40.0, 80.0),  # PSI cpu some avg10, %
+    'io': (30.0, 60.0),  # PSI io some avg10, %
+    'disk': (70.0, 95.0),  # utilisation of the busiest disk, %
+    'load': (1.5, 3.0),  # 1 minute load average per CPU
+}  # all without the share of the transfers themselves
+_governor_disks = None  # disks watched in /proc/diskstats, e.g. ['sda', 'sdb']; None watches all
+_governor_interval = 5  # seconds between samples
+_governor_max_pause = 300  # seconds a transfer may stay stopped at once
 ########################################
 
 
@@ -84,6 +110,305 @@ def _create_logger(path=None, filename=None):
 ########################################
 log = _create_logger(os.path.join(_idrive_root, 'log'))
 
+# Governor of the running daemon, stopped by the signal handler
+_governor = None
+
+
+class Governor(object):
+    """
+    Throttles idevsutil transfers while the NAS is under pressure.
+
+    A background thread samples CPU and IO pressure (/proc/pressure), disk
+    utilisation (/proc/diskstats) and the load average, without the share
+    of the registered transfers. Under moderate pressure the bandwidth in
+    the --bw-file is lowered, under high pressure the registered transfers
+    are stopped with SIGSTOP until the pressure eases. Transfers run below
+    nice/ionice classes via command_prefix.
+    """
+
+    # Pressure has to fall below this share of a threshold to leave a level
+    RECOVER_RATIO = 0.8
+
+    # Seconds of the kernel 1 minute load average
+    LOAD_PERIOD = 60.0
+
+    NORMAL, THROTTLED, PAUSED = 0, 1, 2
+
+    def __init__(self, bw_file, log, thresholds=None, disks=None, interval=5, max_pause=300, bw_normal=100,
+                 bw_throttled=25, command_prefix=''):
+        self.bw_file = bw_file
+        self.log = log
+        self.thresholds = thresholds or {}
+        self.disks = disks
+        self.interval = interval
+        self.max_pause = max_pause
+        self.bw_normal = bw_normal
+        self.bw_throttled = bw_throttled
+        self.command_prefix = command_prefix
+        self.level = self.NORMAL
+        self.throttled_time = 0.0
+        self.paused_time = 0.0
+        self._paused_since = None
+        self._procs = set()
+        self._disk_ticks = None
+        self._own_stats = None
+        self._own_load = 0.0
+        # Reentrant: the signal handler may stop the governor while the main thread holds the lock
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._write_bw(self.bw_normal)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, terminate=False):
+        """
+        Stops sampling, resumes stopped transfers and restores the normal bandwidth.
+
+        :param terminate: Also terminate the registered transfers, e.g. when the daemon exits. The
+                          sampling thread is not waited for then, as it may wait for a lock held by
+                          the interrupted main thread.
+        :return:
+        """
+        self._stop.set()
+        if terminate:
+            with self._lock:
+                for proc in self._procs:
+                    self._signal(proc, signal.SIGTERM)
+                    # Stopped processes only act on SIGTERM once continued
+                    self._signal(proc, signal.SIGCONT)
+        elif self._thread is not None:
+            self._thread.join()
+        self._apply(self.NORMAL)
+
+    def register(self, proc):
+        """
+        Puts a transfer process under control. The process must lead its own process group.
+
+        :param proc: Popen instance
+        :return:
+        """
+        with self._lock:
+            self._procs.add(proc)
+            if self.level == self.PAUSED:
+                self._signal(proc, signal.SIGSTOP)
+
+    def unregister(self, proc):
+        with self._lock:
+            self._procs.discard(proc)
+
+    def reset(self):
+        """
+        Returns and clears the time spent throttled and paused.
+
+        :return: Tuple of throttled and paused seconds
+        """
+        with self._lock:
+            times = self.throttled_time, self.paused_time
+            self.throttled_time = 0.0
+            self.paused_time = 0.0
+        return times
+
+    def _write_bw(self, value):
+        # Replaced in one step, idevsutil may read it any time
+        try:
+            with open(self.bw_file + '.new', 'w') as bw:
+                bw.write('{}\n'.format(value))
+            os.rename(self.bw_file + '.new', self.bw_file)
+        except (IOError, OSError) as exc:
+            self.log.error("Unable to write bandwidth file {}: {}".format(self.bw_file, exc))
+
+    def _signal(self, proc, signum):
+        try:
+            os.killpg(proc.pid, signum)
+        except OSError:
+            # Right after start the process may not have called setsid yet
+            try:
+                os.kill(proc.pid, signum)
+            except OSError:
+                # Process already finished
+                pass
+
+    @staticmethod
+    def _read_psi(resource):
+        try:
+            with open('/proc/pressure/{}'.format(resource)) as psi:
+                for line in psi:
+                    if line.startswith('some'):
+                        return float(line.split()[1].split('=')[1])
+        except (IOError, IndexError, ValueError):
+            pass
+        return None
+
+    def _read_disk_busy(self):
+        """
+        Reads the utilisation of the busiest disk since the last sample.
+
+        :return: Tuple of the percentage and the bytes read and written on the watched disks, or None on the
+                 first sample
+        """
+        now = timer()
+        ticks = dict()
+        try:
+            with open('/proc/diskstats') as diskstats:
+                for line in diskstats:
+                    fields = line.split()
+                    if len(fields) < 13:
+                        continue
+                    name = fields[2]
+                    if self.disks is not None:
+                        if name not in self.disks:
+                            continue
+                    elif name[-1].isdigit() or name.startswith(('loop', 'ram')):
+                        continue
+                    # io ticks and sectors read and written
+                    ticks[name] = int(fields[12]), (int(fields[5]) + int(fields[9])) * 512
+        except (IOError, ValueError):
+            return None
+
+        previous, self._disk_ticks = self._disk_ticks, (now, ticks)
+        if previous is None or now <= previous[0]:
+            return None
+        elapsed_ms = (now - previous[0]) * 1000
+        names = [name for name in ticks if name in previous[1]]
+        if not names:
+            return None
+        busy = max((ticks[name][0] - previous[1][name][0]) / elapsed_ms * 100 for name in names)
+        return busy, sum(ticks[name][1] - previous[1][name][1] for name in names)
+
+    def _read_own_usage(self):
+        """
+        Reads what the registered transfers used since the last sample.
+
+        All processes in the process groups of the transfers are counted.
+
+        :return: Tuple of bytes read and written (/proc/<pid>/io), seconds waited for a CPU
+                 (/proc/<pid>/schedstat), number of processes running or in disk sleep and the seconds
+                 since the last sample; the first two are None on the first sample
+        """
+        now = timer()
+        with self._lock:
+            groups = set(proc.pid for proc in self._procs)
+        stats = dict()
+        active = 0
+        for name in os.listdir('/proc') if groups else []:
+            if not name.isdigit():
+                continue
+            try:
+                with open('/proc/{}/stat'.format(name)) as stat_file:
+                    # State and process group follow the command name
+                    fields = stat_file.read().rsplit(')', 1)[1].split()
+                if int(fields[2]) not in groups:
+                    continue
+                io_bytes = 0
+                with open('/proc/{}/io'.format(name)) as io_file:
+                    for line in io_file:
+                        if line.startswith(('read_bytes', 'write_bytes')):
+                            io_bytes += int(line.split()[1])
+                with open('/proc/{}/schedstat'.format(name)) as schedstat:
+                    wait_ns = int(schedstat.read().split()[1])
+            except (IOError, IndexError, ValueError):
+                # Process finished or not readable
+                continue
+            if fields[0] in ('R', 'D'):
+                active += 1
+            stats[name] = io_bytes, wait_ns
+
+        previous, self._own_stats = self._own_stats, (now, stats)
+        if previous is None:
+            return None, None, active, 0.0
+        io_bytes = sum(value[0] - previous[1].get(name, (0, 0))[0] for name, value in stats.items())
+        wait_ns = sum(value[1] - previous[1].get(name, (0, 0))[1] for name, value in stats.items())
+        return max(io_bytes, 0), max(wait_ns, 0) / 1e9, active, now - previous[0]
+
+    def sample(self):
+        """
+        Samples the pressure metrics without the share of the registered transfers.
+
+        Disk utilisation and IO pressure are scaled by the share of the disk traffic the transfers did not
+        cause, CPU pressure is lowered by the time the transfers waited for a CPU and the load average by the
+        number of transfer processes running or in disk sleep, averaged the way the kernel does. Stopped
+        transfers have no share, so the samples taken while paused show the pressure of the rest of the NAS.
+
+        :return: Dict of metric name to value; unavailable metrics are left out
+        """
+        disk = self._read_disk_busy()
+        own_bytes, own_wait, own_active, elapsed = self._read_own_usage()
+        decay = math.exp(-elapsed / self.LOAD_PERIOD)
+        self._own_load = self._own_load * decay + own_active * (1 - decay)
+
+        other_share = 1.0
+        if disk is not None and own_bytes is not None and disk[1] > 0:
+            other_share = 1.0 - min(float(own_bytes) / disk[1], 1.0)
+        cpu = self._read_psi('cpu')
+        if cpu is not None and own_wait is not None and elapsed > 0:
+            cpu = max(cpu - own_wait / elapsed * 100, 0.0)
+        io = self._read_psi('io')
+        samples = {'cpu': cpu,
+                   'io': io * other_share if io is not None else None,
+                   'disk': disk[0] * other_share if disk is not None else None,
+                   'load': max(os.getloadavg()[0] - self._own_load, 0.0) / max(os.sysconf('SC_NPROCESSORS_ONLN'), 1)}
+        return dict((name, value) for name, value in samples.items() if value is not None)
+
+    def _level_for(self, samples, scale=1.0):
+        level = self.NORMAL
+        for name, value in samples.items():
+            if name not in self.thresholds:
+                continue
+            throttle, pause = self.thresholds[name]
+            if value > pause * scale:
+                return self.PAUSED
+            if value > throttle * scale:
+                level = self.THROTTLED
+        return level
+
+    def _apply(self, level):
+        with self._lock:
+            if level == self.level:
+                return
+            if self.level == self.PAUSED:
+                for proc in self._procs:
+                    self._signal(proc, signal.SIGCONT)
+                self._paused_since = None
+            if level == self.PAUSED:
+                for proc in self._procs:
+                    self._signal(proc, signal.SIGSTOP)
+                self._paused_since = timer()
+            previous, self.level = self.level, level
+        if level == self.NORMAL:
+            self._write_bw(self.bw_normal)
+        elif previous == self.NORMAL:
+            self._write_bw(self.bw_throttled)
+        self.log.info("Governor: transfers {}.".format(('resumed', 'throttled', 'paused')[level]))
+
+    def _run(self):
+        last = timer()
+        while not self._stop.wait(self.interval):
+            samples = self.sample()
+            level = self._level_for(samples)
+            if level < self.level:
+                # Hysteresis: only step down once pressure eased enough
+                level = max(level, min(self._level_for(samples, self.RECOVER_RATIO), self.level))
+            if level == self.PAUSED and self._paused_since is not None \
+                    and timer() - self._paused_since > self.max_pause:
+                # Let the transfer run for one interval so its connection does not time out
+                level = self.THROTTLED
+
+            now = timer()
+            with self._lock:
+                if self.level == self.PAUSED:
+                    self.paused_time += now - last
+                if self.level != self.NORMAL:
+                    self.throttled_time += now - last
+            last = now
+
+            if level != self.level:
+                self.log.debug("Governor samples: {}".format(samples))
+            self._apply(level)
+
 
 def daemon_terminate(signum, frame):
     """
@@ -94,6 +419,9 @@ def daemon_terminate(signum, frame):
     :return:
     """
     log.info("IDrive daemon terminated. Received signal: {} at frame: {}".format(signum, frame))
+    if _governor is not None:
+        # Children run in their own sessions and would outlive the daemon, possibly stopped
+        _governor.stop(terminate=True)
     sys.exit(0)
 
 
@@ -103,6 +431,7 @@ def run():
 
     :return:
     """
+    global _governor
     print "Starting IDrive daemon..."
 
     ########################################
@@ -136,9 +465,23 @@ def run():
 
     # Open the daemon
     with context:
+        # Open the ledger inside the daemon, the connection must not cross the fork
+        ledger = Ledger(_ledger_db)
+        # Threads do not survive the fork either
+        governor = Governor(_governor_bw_file, log,
+                            thresholds=_governor_thresholds,
+                            disks=_governor_disks,
+                            interval=_governor_interval,
+                            max_pause=_governor_max_pause,
+                            bw_normal=_governor_bw_normal,
+                            bw_throttled=_governor_bw_throttled,
+                            command_prefix=_governor_nice)
+        governor.start()
+        _governor = governor
         while True:
             # Run the backup command
             log.info("Starting backup.")
+            governor.reset()
             up_start = timer()
             up_rc = run_backup(idrive_root=_idrive_root,
                                destination=_destination,
@@ -146,8 +489,14 @@ def run():
                                pwd_file=_pwd_file,
                                pvt_key=_pvt_key,
                                files_from=_files_from,
-                               log=log)
+                               log=log,
+                               weights=_upload_weights,
+                               ledger=ledger,
+                               chunk_threshold=_chunk_threshold,
+                               governor=governor,
+                               pipeline=_upload_pipeline)
             up_end = timer()
+            up_throttled, up_paused = governor.reset()
             if up_rc == 0:
                 log.info("Backup time elapsed: {}".format(up_start - up_end))
             else:
@@ -162,8 +511,14 @@ def run():
                                    pwd_file=_pwd_file,
                                    pvt_key=_pvt_key,
                                    files_from=_download_from,
-                                   log=log)
+                                   log=log,
+                                   staging_path=_staging_path,
+                                   staging_budget=_staging_budget,
+                                   use_events=_use_events,
+                                   ledger=ledger,
+                                   governor=governor)
             down_end = timer()
+            down_throttled, down_paused = governor.reset()
             if down_rc == 0:
                 log.info("Download time elapsed: {}".format(down_end - down_start))
             else:
@@ -175,6 +530,14 @@ def run():
                                                                                  up_end - up_start,
                                                                                  down_rc,
                                                                                  down_end - down_start))
+            log.info("[Summary] "
+                     "Backup throttled for {:.0f} seconds (paused {:.0f}). "
+                     "Download throttled for {:.0f} seconds (paused {:.0f}).".format(up_throttled,
+                                                                                     up_paused,
+                                                                                     down_throttled,
+                                                                                     down_paused))
+            ledger.purge(_ledger_retention)
+
             # now sleep for n*60 seconds
             time.sleep(interval * 60)
 
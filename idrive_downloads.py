@@ -9,6 +9,13 @@ Run cmd:
 
 import os
 import sys
+import re
+import stat
+import time
+import json
+import shutil
+import signal
+import threading
 from subprocess import Popen, PIPE
 import logging
 from logging.handlers import RotatingFileHandler
@@ -16,6 +23,16 @@ import argparse
 from xml.etree import ElementTree as et
 import errno
 
+try:
+    import Queue as queue
+except ImportError:  # Python 3
+    import queue
+
+from idrive_transfer import TransferTuner, list_taker, run_transfers, \
+    tuning_file
+from idrive_chunks import assemble_file, chunk_entry, is_chunk_entry, \
+    is_manifest_entry, local_chunks, read_manifest
+
 __author__ = 'kpiwk'
 
 
@@ -24,6 +41,39 @@ DEBUG = True
 # The name of the idrive binary
 IDRIVE_BIN = 'idevsutil'
 
+# Number of download list entries fetched by one idevsutil run until the
+# tuner learned better
+DOWNLOAD_BATCH_SIZE = 100
+
+# Buffer used when a staged file has to be copied across file systems
+STAGING_COPY_BUFFER = 8 * 1024 * 1024
+
+# Seconds between two checks of the staging area against its budget
+STAGING_POLL_INTERVAL = 2
+
+# Seconds between two sweeps moving the finished files of running batches
+STAGING_SWEEP_INTERVAL = 10
+
+# Chunk bytes fetched at once to rebuild a chunked file without a staging
+# budget
+CHUNK_FETCH_BYTES = 256 * 1024 * 1024
+
+# Seconds a staged download may be held at once, so its connection does not
+# time out
+STAGING_MAX_HOLD = 300
+
+# Event cursors older than this fall back to a full comparison
+EVENT_CURSOR_MAX_AGE = 7 * 24 * 3600
+
+# Event operations which do not bring new files to download
+EVENT_SKIP_OPERATIONS = ('delete', 'trash')
+
+# Event operations whose files are downloaded under their new path
+EVENT_RENAME_OPERATIONS = ('rename',)
+
+_NEW_PATH_RE = re.compile(r'new[_-]?(?:path|fname|name)\s*=\s*"([^"]*)"',
+                          re.IGNORECASE)
+
 
 def _create_logger(path=None, filename=None):
     if path is not None:
@@ -98,13 +148,14 @@ def _exec_cmd(cmd=None, usr_input=None, log=None, debug=DEBUG):
     return ret, proc.returncode
 
 
-def _exec_cmd_flush(cmd=None, usr_input=None, log=None, debug=DEBUG):
+def _exec_cmd_flush(cmd=None, usr_input=None, log=None, debug=DEBUG, governor=None):
     """
     Executes a command line command.
 
     :param cmd: Command to execute
     :param usr_input: (Optional) Input to pass to the executed command
     :param debug: Enables debug logging if True
+    :param governor: (Optional) Governor throttling the command under load
     :return:
     """
 
@@ -112,21 +163,37 @@ def _exec_cmd_flush(cmd=None, usr_input=None, log=None, debug=DEBUG):
         log = _create_logger(path='{}/log'.format(
             os.path.join(os.path.dirname(__file__), '..')))
 
+    if governor is not None:
+        # Run governed commands in their own process group, so they can be
+        # stopped as a whole. The shell execs setsid, which is no group
+        # leader then and execs the command in place: proc.pid leads the
+        # group.
+        cmd = ' '.join(part for part in ('exec setsid',
+                                         governor.command_prefix, cmd)
+                       if part)
+
     if debug:
         log.debug("Executing command: {0}".format(cmd))
 
     proc = Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE, stdin=PIPE)
+    if governor is not None:
+        governor.register(proc)
 
     # Poll process for new output until finished
+    lines = []
     while True:
         next_line = proc.stdout.readline()
         if next_line == '' and proc.poll() is not None:
             break
         # sys.stdout.write(next_line)
         # sys.stdout.flush()
-        log.debug(next_line)
+        if next_line:
+            lines.append(next_line)
+            log.debug(next_line)
 
     ret, err = proc.communicate(input=usr_input)
+    if governor is not None:
+        governor.unregister(proc)
 
     if debug:
         if ret:
@@ -137,7 +204,7 @@ def _exec_cmd_flush(cmd=None, usr_input=None, log=None, debug=DEBUG):
     # assert proc.returncode == 0, 'Aborting. Return code: {0}'.format(
     # proc.returncode)
 
-    return ret, proc.returncode
+    return ''.join(lines) + (ret or ''), proc.returncode
 
 
 def _flush_print(text=None, sub=None):
@@ -149,6 +216,875 @@ def _flush_print(text=None, sub=None):
     sys.stdout.flush()
 
 
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as exc:  # Python >2.5
+        if exc.errno == errno.EEXIST and os.path.isdir(path):
+            pass
+        else:
+            raise
+
+
+def _read_file_list(files_from):
+    """
+    Reads a files-from list.
+
+    :param files_from: Full path to the list file
+    :return: List of non-empty entries
+    """
+    with open(files_from) as list_file:
+        return [line.rstrip('\n') for line in list_file if line.strip()]
+
+
+def _write_file_list(files_from, entries):
+    with open(files_from, 'w') as list_file:
+        for entry in entries:
+            list_file.write('{}\n'.format(entry))
+
+
+def _dir_size(path):
+    """
+    Sums the disk space used by all files below the path.
+
+    :param path: Directory to measure
+    :return: Size in bytes; sparse placeholders count with their allocated blocks only
+    """
+    total = 0
+    for dir_path, _, file_names in os.walk(path):
+        for file_name in file_names:
+            try:
+                total += os.lstat(os.path.join(dir_path, file_name)).st_blocks * 512
+            except OSError:
+                # File was moved away in the meantime
+                pass
+    return total
+
+
+def _scratch_used(path):
+    """
+    Measures the disk space used in the staging area.
+
+    A staging area mounted on its own (e.g. a tmpfs) is measured with
+    statvfs; otherwise the files below it are summed.
+
+    :param path: Staging directory
+    :return: Used bytes
+    """
+    if os.path.ismount(path):
+        fs_stat = os.statvfs(path)
+        return (fs_stat.f_blocks - fs_stat.f_bfree) * fs_stat.f_frsize
+    return _dir_size(path)
+
+
+def _seed_batch(batch_dir, batch, target_path):
+    """
+    Mirrors the target copies of the batch entries into the batch directory.
+
+    Every existing file gets a sparse placeholder with the size, mtime and
+    mode of its target copy, so the idevsutil comparison finds unchanged
+    files in sync and only new or changed files are downloaded to the
+    scratch area.
+
+    :param batch_dir: Empty staged batch directory
+    :param batch: Download list entries of the batch
+    :param target_path: Download target path
+    :return: Set of (device, inode) tuples of the placeholders
+    """
+    placeholders = set()
+    for entry in batch:
+        src_path = os.path.normpath(os.path.join(target_path, entry.lstrip('/')))
+        if os.path.isfile(src_path):
+            candidates = [(os.path.dirname(src_path), [],
+                           [os.path.basename(src_path)])]
+        else:
+            candidates = os.walk(src_path)
+        for dir_path, _, file_names in candidates:
+            rel_path = os.path.relpath(dir_path, target_path)
+            for file_name in file_names:
+                try:
+                    file_stat = os.lstat(os.path.join(dir_path, file_name))
+                except OSError:
+                    continue
+                dst = os.path.normpath(os.path.join(batch_dir, rel_path,
+                                                    file_name))
+                if not stat.S_ISREG(file_stat.st_mode) \
+                        or os.path.lexists(dst):
+                    continue
+                _makedirs(os.path.dirname(dst))
+                with open(dst, 'wb') as placeholder:
+                    placeholder.truncate(file_stat.st_size)
+                os.chmod(dst, stat.S_IMODE(file_stat.st_mode))
+                os.utime(dst, (file_stat.st_atime, file_stat.st_mtime))
+                dst_stat = os.lstat(dst)
+                placeholders.add((dst_stat.st_dev, dst_stat.st_ino))
+    return placeholders
+
+
+def _move_file(src, dst):
+    """
+    Atomically places a staged file in the target tree.
+
+    A plain rename is used when both paths are on the same file system.
+    Otherwise the file is copied with large sequential writes to a hidden
+    part file next to the destination and renamed into place, so a half
+    written file is never visible under its final name.
+
+    :param src: Staged file
+    :param dst: Final file path
+    :return:
+    """
+    _makedirs(os.path.dirname(dst))
+    try:
+        os.rename(src, dst)
+        return
+    except OSError as exc:
+        if exc.errno != errno.EXDEV:
+            raise
+
+    part = os.path.join(os.path.dirname(dst),
+                        '.{}.idrive-part'.format(os.path.basename(dst)))
+    with open(src, 'rb') as src_file:
+        with open(part, 'wb') as part_file:
+            shutil.copyfileobj(src_file, part_file, STAGING_COPY_BUFFER)
+            part_file.flush()
+            os.fsync(part_file.fileno())
+    shutil.copystat(src, part)
+    os.rename(part, dst)
+    os.remove(src)
+
+
+def _move_tree(src_root, dst_root, log, placeholders=None, final=True):
+    """
+    Moves the downloaded files of a staged batch into the target tree.
+
+    Placeholders left untouched by idevsutil stand for files in sync.
+    idevsutil replaces the placeholders of changed files, so those have a
+    new inode and are moved. While the batch still runs (final False) the
+    placeholders and folders are left in place for idevsutil.
+
+    :param src_root: Staged batch directory
+    :param dst_root: Download target path
+    :param log: Logger instance
+    :param placeholders: (Optional) Set of (device, inode) tuples from _seed_batch
+    :param final: True once idevsutil finished the batch
+    :return: Tuple of the number of moved files and of files which could not be moved
+    """
+    if placeholders is None:
+        placeholders = set()
+    moved = 0
+    failed = 0
+    for dir_path, _, file_names in os.walk(src_root, topdown=False):
+        rel_path = os.path.relpath(dir_path, src_root)
+        for file_name in file_names:
+            src = os.path.join(dir_path, file_name)
+            dst = os.path.normpath(os.path.join(dst_root, rel_path, file_name))
+            try:
+                src_stat = os.lstat(src)
+                if (src_stat.st_dev, src_stat.st_ino) in placeholders:
+                    if final:
+                        os.remove(src)
+                else:
+                    _move_file(src, dst)
+                    moved += 1
+            except (IOError, OSError) as exc:
+                log.error("Unable to move {} to {}: {}".format(src, dst, exc))
+                failed += 1
+        if final and not os.listdir(dir_path):
+            os.rmdir(dir_path)
+    return moved, failed
+
+
+class _StagingMover(object):
+    """
+    Moves downloaded files out of the staging area into the target tree.
+
+    Finished batches are moved as a whole. Files of running batches are
+    moved every sweep: idevsutil downloads into its --temp directory and
+    only renames finished files into the batch directory, so every file
+    there which is not a placeholder is complete.
+    """
+
+    def __init__(self, target_path, log, interval=STAGING_SWEEP_INTERVAL):
+        self.target_path = target_path
+        self.log = log
+        self.interval = interval
+        self.failed = 0
+        self._running = dict()
+        self._jobs = queue.Queue()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._jobs.put(None)
+        self._thread.join()
+
+    def add(self, batch_dir, placeholders):
+        """
+        Registers a running batch for the sweeps.
+
+        :param batch_dir: Staged batch directory
+        :param placeholders: Set of (device, inode) tuples from _seed_batch
+        :return:
+        """
+        self._running[batch_dir] = placeholders
+
+    def finish(self, batch_dir):
+        """
+        Queues a batch idevsutil is done with to be moved as a whole.
+
+        :param batch_dir: Staged batch directory
+        :return:
+        """
+        self._jobs.put(('batch', batch_dir, self._running.pop(batch_dir)))
+
+    def join(self):
+        """
+        Waits until all finished batches are moved.
+
+        :return:
+        """
+        self._jobs.join()
+
+    def sweep(self):
+        """
+        Moves the finished files of the running batches now.
+
+        :return: Number of files moved by this sweep and the batches queued before it
+        """
+        result = []
+        done = threading.Event()
+        self._jobs.put(('sweep', result, done))
+        done.wait()
+        return result[0]
+
+    def _move(self, batch_dir, placeholders, final):
+        moved, failed = _move_tree(batch_dir, self.target_path, self.log,
+                                   placeholders, final=final)
+        self.failed += failed
+        return moved
+
+    def _run(self):
+        moved = 0
+        while True:
+            try:
+                job = self._jobs.get(timeout=self.interval)
+            except queue.Empty:
+                for batch_dir, placeholders in list(self._running.items()):
+                    self._move(batch_dir, placeholders, False)
+                continue
+            try:
+                if job is None:
+                    return
+                if job[0] == 'batch':
+                    moved += self._move(job[1], job[2], True)
+                    self.log.debug("Moved staged batch {} into {}".format(
+                        job[1], self.target_path))
+                else:
+                    for batch_dir, placeholders in list(self._running.items()):
+                        moved += self._move(batch_dir, placeholders, False)
+                    job[1].append(moved)
+                    moved = 0
+                    job[2].set()
+            except Exception as exc:
+                self.log.error("Staging mover failed on {}: {}".format(job, exc))
+                self.failed += 1
+                if job is not None and job[0] == 'sweep' and not job[2].is_set():
+                    job[1].append(moved)
+                    job[2].set()
+            finally:
+                self._jobs.task_done()
+
+
+class _StagingGuard(object):
+    """
+    Holds staged downloads while the staging area is over budget.
+
+    Takes the place of the governor for the staged batches: commands keep
+    the governor prefix and the processes are registered with both. While
+    the staging area is over budget the running idevsutil processes are
+    stopped with SIGSTOP and the mover sweeps the running batches. Once a
+    sweep finds nothing to move the space is held by files still
+    downloading, which only the downloads themselves can finish, so they
+    are let go on.
+    """
+
+    def __init__(self, staging_path, budget, mover, log, governor=None,
+                 interval=STAGING_POLL_INTERVAL, max_hold=STAGING_MAX_HOLD):
+        self.staging_path = staging_path
+        self.budget = budget
+        self.mover = mover
+        self.log = log
+        self.governor = governor
+        self.interval = interval
+        self.max_hold = max_hold
+        self.command_prefix = governor.command_prefix \
+            if governor is not None else ''
+        self.held = False
+        self.held_time = 0.0
+        self._held_since = None
+        self._procs = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._hold(False)
+
+    def register(self, proc):
+        """
+        Puts a download process under control. The process must lead its
+        own process group.
+
+        :param proc: Popen instance
+        :return:
+        """
+        if self.governor is not None:
+            self.governor.register(proc)
+        with self._lock:
+            self._procs.add(proc)
+            if self.held:
+                self._signal(proc, signal.SIGSTOP)
+
+    def unregister(self, proc):
+        with self._lock:
+            self._procs.discard(proc)
+        if self.governor is not None:
+            self.governor.unregister(proc)
+
+    @staticmethod
+    def _signal(proc, signum):
+        try:
+            os.killpg(proc.pid, signum)
+        except OSError:
+            # Right after start the process may not have called setsid yet
+            try:
+                os.kill(proc.pid, signum)
+            except OSError:
+                # Process already finished
+                pass
+
+    def _hold(self, hold):
+        with self._lock:
+            if hold:
+                # Stopped again on every check, the governor may have
+                # resumed them meanwhile
+                for proc in self._procs:
+                    self._signal(proc, signal.SIGSTOP)
+                if not self.held:
+                    self._held_since = time.time()
+            elif self.held:
+                if self.governor is None \
+                        or self.governor.level != self.governor.PAUSED:
+                    for proc in self._procs:
+                        self._signal(proc, signal.SIGCONT)
+                self.held_time += time.time() - self._held_since
+                self._held_since = None
+            changed, self.held = hold != self.held, hold
+        if changed:
+            self.log.info("Staged downloads {}.".format(
+                'held, staging area over budget' if hold else 'resumed'))
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if _scratch_used(self.staging_path) < self.budget:
+                self._hold(False)
+                continue
+            if self._held_since is not None \
+                    and time.time() - self._held_since > self.max_hold:
+                # Let the downloads run for one interval
+                self._hold(False)
+                continue
+            self._hold(True)
+            moved = self.mover.sweep()
+            if not moved or _scratch_used(self.staging_path) < self.budget:
+                self._hold(False)
+
+
+def _download_batches(cmd, entries, list_path, tuner, log, ledger=None,
+                      run_id=None, governor=None):
+    """
+    Downloads the entries straight to the target in tuned batches.
+
+    :param cmd: Download command template with a file_list placeholder
+    :param entries: Download list entries
+    :param list_path: Folder for the per batch file lists
+    :param tuner: TransferTuner instance
+    :param log: Logger instance
+    :param ledger: (Optional) Ledger recording the transferred files
+    :param run_id: Ledger run id
+    :param governor: (Optional) Governor throttling the transfers under load
+    :return: Return code of the first failed batch, 0 otherwise
+    """
+    _makedirs(list_path)
+
+    def _run_batch(batch_no, batch):
+        batch_list = os.path.join(list_path,
+                                  'download-batch-{:05d}'.format(batch_no))
+        _write_file_list(batch_list, batch)
+        output, batch_rc = _exec_cmd_flush(cmd=cmd.format(file_list=batch_list),
+                                           log=log,
+                                           governor=governor)
+        os.remove(batch_list)
+        return output, batch_rc
+
+    results = run_transfers(take=list_taker(entries),
+                            run_batch=_run_batch,
+                            tuner=tuner,
+                            log=log,
+                            after_batch=ledger.recorder(run_id)
+                            if ledger is not None else None)
+    return _first_failure(results, log)
+
+
+def _first_failure(results, log):
+    ret_code = 0
+    for batch_no, _, _, batch_rc in results:
+        if batch_rc != 0:
+            log.error("Download batch {} failed. Return code was: "
+                      "{}".format(batch_no, batch_rc))
+            if ret_code == 0:
+                ret_code = batch_rc
+    return ret_code
+
+
+def _download_staged(cmd, entries, staging_path, staging_budget,
+                     target_path, tuner, log, ledger=None, run_id=None,
+                     governor=None):
+    """
+    Downloads the entries in batches to a scratch area.
+
+    Every batch is downloaded into its own directory below the staging path
+    with its idevsutil temp directory on the same scratch area. The batch
+    directory is seeded with placeholders of the target copies, so only
+    new or changed files are downloaded. A background mover moves the
+    finished files into the target tree while the batches download.
+
+    With a budget, running downloads are held while the scratch area is
+    over budget and the mover frees space, and the next round waits until
+    the mover caught up. The budget is a soft limit: files still being
+    downloaded can not be moved, so the scratch area can exceed it by the
+    files in flight.
+
+    :param cmd: Download command template with file_list, temp and target
+    :param entries: Download list entries
+    :param staging_path: Scratch directory (tmpfs/SSD)
+    :param staging_budget: (Optional) Scratch space limit in bytes
+    :param target_path: Final download location
+    :param tuner: TransferTuner instance
+    :param log: Logger instance
+    :param ledger: (Optional) Ledger recording the transferred files
+    :param run_id: Ledger run id
+    :param governor: (Optional) Governor throttling the transfers under load
+    :return: Return code of the first failed batch, 0 otherwise
+    """
+    temp_path = os.path.join(staging_path, 'tmp')
+    list_path = os.path.join(staging_path, 'lists')
+    _makedirs(list_path)
+
+    mover = _StagingMover(target_path, log)
+    mover.start()
+
+    guard = None
+    if staging_budget is not None:
+        guard = _StagingGuard(staging_path, staging_budget, mover, log,
+                              governor=governor)
+        guard.start()
+        governor = guard
+
+    def _wait_for_space():
+        if staging_budget is None:
+            return
+        used = _scratch_used(staging_path)
+        if used >= staging_budget:
+            log.info("Staging area holds {} bytes (budget {}). "
+                     "Waiting for mover.".format(used, staging_budget))
+            wait_start = time.time()
+            mover.join()
+            log.info("Waited {:.1f} seconds for staging "
+                     "space.".format(time.time() - wait_start))
+
+    def _run_batch(batch_no, batch):
+        batch_list = os.path.join(list_path, 'batch-{:05d}'.format(batch_no))
+        batch_dir = os.path.join(staging_path, 'batch-{:05d}'.format(batch_no))
+        batch_temp = os.path.join(temp_path, 'batch-{:05d}'.format(batch_no))
+        _makedirs(batch_dir)
+        _makedirs(batch_temp)
+        _write_file_list(batch_list, batch)
+        mover.add(batch_dir, _seed_batch(batch_dir, batch, target_path))
+
+        output, batch_rc = _exec_cmd_flush(cmd=cmd.format(file_list=batch_list,
+                                                          temp=batch_temp,
+                                                          target=batch_dir),
+                                           log=log,
+                                           governor=governor)
+        os.remove(batch_list)
+        shutil.rmtree(batch_temp, ignore_errors=True)
+        # Partially downloaded batches are moved as well; idevsutil
+        # only leaves finished files outside of its temp directory
+        mover.finish(batch_dir)
+        return output, batch_rc
+
+    try:
+        results = run_transfers(take=list_taker(entries),
+                                run_batch=_run_batch,
+                                tuner=tuner,
+                                log=log,
+                                before_round=_wait_for_space,
+                                after_batch=ledger.recorder(run_id)
+                                if ledger is not None else None)
+    finally:
+        if guard is not None:
+            guard.stop()
+            if guard.held_time:
+                log.info("Downloads held for {:.0f} seconds waiting for "
+                         "staging space.".format(guard.held_time))
+        mover.stop()
+
+    ret_code = _first_failure(results, log)
+    if mover.failed and ret_code == 0:
+        ret_code = 1
+    return ret_code
+
+
+def _download_chunked(cmd, manifest_entries, scratch_path, target_path, log,
+                      staging_budget=None, governor=None):
+    """
+    Rebuilds files uploaded in chunks.
+
+    The manifests are downloaded first. Chunks still found in the current
+    local copy of a file are reused. The others are downloaded while the
+    file is rebuilt, in runs of up to the staging budget, and removed once
+    written, so the scratch folder stays within the budget.
+
+    :param cmd: Download command template with file_list and target
+    :param manifest_entries: Download list entries of manifests
+    :param scratch_path: Scratch folder for manifests and chunks
+    :param target_path: Download target path
+    :param log: Logger instance
+    :param staging_budget: (Optional) Scratch space limit in bytes
+    :param governor: (Optional) Governor throttling the transfers under load
+    :return: Return code
+    """
+    _makedirs(scratch_path)
+    list_file = os.path.join(scratch_path, 'chunk-list')
+    failures = []
+
+    def _fetch(digests):
+        _write_file_list(list_file, [chunk_entry(digest) for digest in digests])
+        _, chunks_rc = _exec_cmd_flush(cmd=cmd.format(file_list=list_file,
+                                                      target=scratch_path),
+                                       log=log,
+                                       governor=governor)
+        if chunks_rc != 0:
+            failures.append(chunks_rc)
+            raise IOError("Chunk download failed. Return code was: "
+                          "{}".format(chunks_rc))
+
+    try:
+        _write_file_list(list_file, manifest_entries)
+        _, ret_code = _exec_cmd_flush(cmd=cmd.format(file_list=list_file,
+                                                     target=scratch_path),
+                                      log=log,
+                                      governor=governor)
+        if ret_code != 0:
+            log.error("Manifest download failed. Return code was: "
+                      "{}".format(ret_code))
+            return ret_code
+
+        jobs = []
+        missing = set()
+        for entry in manifest_entries:
+            try:
+                manifest = read_manifest(os.path.join(scratch_path,
+                                                      entry.lstrip('/')))
+            except (IOError, ValueError) as exc:
+                log.error("Unable to read manifest {}: {}".format(entry, exc))
+                ret_code = 1
+                continue
+            dst = os.path.normpath(os.path.join(target_path,
+                                                manifest['path'].lstrip('/')))
+            reuse = local_chunks(dst)
+            missing.update(digest for digest, _ in manifest['chunks']
+                           if digest not in reuse)
+            jobs.append((manifest, dst, reuse))
+
+        log.info("Rebuilding {} chunked files from {} downloaded "
+                 "chunks.".format(len(jobs), len(missing)))
+        for manifest, dst, reuse in jobs:
+            try:
+                assemble_file(manifest, dst, scratch_path, reuse,
+                              fetch=_fetch,
+                              fetch_bytes=staging_budget or CHUNK_FETCH_BYTES)
+            except (IOError, OSError) as exc:
+                log.error("Unable to rebuild {}: {}".format(dst, exc))
+                if ret_code == 0:
+                    ret_code = failures[-1] if failures else 1
+        return ret_code
+    finally:
+        shutil.rmtree(scratch_path, ignore_errors=True)
+
+
+def _event_cursor_file(idrive_root, source):
+    source = re.sub(r'[^A-Za-z0-9.-]', '_', source.replace('\\', ''))
+    return os.path.join(idrive_root, 'cfg', 'events-{}.json'.format(source))
+
+
+def _read_event_cursor(cursor_file):
+    """
+    Reads the stored server event cursor.
+
+    :param cursor_file: Full path to the cursor file
+    :return: Dict with year, month, eventid and updated or None
+    """
+    try:
+        with open(cursor_file) as cursor:
+            return json.load(cursor)
+    except (IOError, ValueError):
+        return None
+
+
+def _write_event_cursor(cursor_file, cursor):
+    _makedirs(os.path.dirname(cursor_file))
+    with open(cursor_file + '.new', 'w') as cursor_out:
+        json.dump(cursor, cursor_out)
+    os.rename(cursor_file + '.new', cursor_file)
+
+
+def _event_months(year, month, now=None):
+    """
+    Lists the (year, month) pairs from the given month up to now.
+
+    :param year: First year
+    :param month: First month
+    :param now: (Optional) Unix timestamp of the last month
+    :return: List of (year, month) tuples
+    """
+    last = time.localtime(now)
+    months = []
+    while (year, month) <= (last.tm_year, last.tm_mon):
+        months.append((year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+
+def _parse_event_list(output):
+    """
+    Parses the event table printed for --event-month/--event-year.
+
+    Only rows below the table header (the line holding EVENT ID) are
+    taken; output without the header is not an event table.
+
+    :param output: idevsutil output
+    :return: List of (operation, date, event id) tuples in server order,
+             None if no table header was found
+    """
+    events = []
+    header = False
+    for line in (output or '').splitlines():
+        if 'EVENT ID' in line:
+            header = True
+            continue
+        cells = [cell.strip() for cell in line.strip().strip('|').split('|')]
+        if not header or len(cells) < 3 or not cells[-1]:
+            continue
+        events.append((cells[0], cells[1], cells[-1]))
+    return events if header else None
+
+
+def _parse_event_file(path, renamed=False):
+    """
+    Reads the file paths touched by a saved event.
+
+    :param path: Event file written by --save-event
+    :param renamed: Read the new paths of a rename event
+    :return: List of server paths
+    """
+    with open(path) as event_file:
+        content = event_file.read()
+    if renamed:
+        return _NEW_PATH_RE.findall(content)
+    paths = re.findall(r'fname\s*=\s*"([^"]*)"', content)
+    if paths:
+        return paths
+    return [line.strip() for line in content.splitlines() if line.strip().startswith('/')]
+
+
+def _list_events(cmd, year, month, log):
+    output, ret_code = _exec_cmd(cmd=cmd.format(month='{:02d}'.format(month),
+                                                year=year),
+                                 log=log)
+    if ret_code != 0:
+        log.error("Unable to list events for {}-{:02d}. Return code was: "
+                  "{}".format(year, month, ret_code))
+        return None
+    events = _parse_event_list(output)
+    if events is None:
+        log.info("Unable to read the events for {}-{:02d}.".format(year,
+                                                                  month))
+    return events
+
+
+def _fetch_event_paths(cmd, year, month, event_id, save_path, log,
+                       renamed=False):
+    event_path = os.path.join(save_path, re.sub(r'[^A-Za-z0-9.-]', '_',
+                                                event_id))
+    _makedirs(event_path)
+    try:
+        _, ret_code = _exec_cmd(cmd=cmd.format(month='{:02d}'.format(month),
+                                               year=year,
+                                               event_id=event_id,
+                                               save_path=event_path),
+                                log=log)
+        if ret_code != 0:
+            log.error("Unable to fetch event {}. Return code was: "
+                      "{}".format(event_id, ret_code))
+            return None
+        paths = []
+        for file_name in os.listdir(event_path):
+            paths.extend(_parse_event_file(os.path.join(event_path,
+                                                        file_name),
+                                           renamed=renamed))
+        if renamed and not paths:
+            log.info("No new path found in rename event {}.".format(event_id))
+            return None
+        return paths
+    finally:
+        shutil.rmtree(event_path, ignore_errors=True)
+
+
+def _source_entry(path, source):
+    """
+    Maps a server path to a download list entry relative to the source.
+
+    :param path: Server path from an event
+    :param source: Source folder below home/
+    :return: Entry starting with / or None if outside of the source
+    """
+    rel_path = path.lstrip('/')
+    if rel_path.startswith('home/'):
+        rel_path = rel_path[len('home/'):]
+    prefix = source.replace('\\', '').strip('/') + '/'
+    if not rel_path.startswith(prefix):
+        return None
+    return '/' + rel_path[len(prefix):]
+
+
+def _in_download_list(entry, download_list):
+    """
+    Checks whether an entry lies below one of the download list entries.
+
+    :param entry: Entry starting with /
+    :param download_list: Download list entries
+    :return: True if the full comparison would fetch the entry
+    """
+    for listed in download_list:
+        listed = '/' + listed.strip('/')
+        if listed == '/' or entry == listed or entry.startswith(listed + '/'):
+            return True
+    return False
+
+
+def _latest_event_cursor(list_cmd, log, now=None):
+    """
+    Builds a cursor pointing to the newest event of the current month.
+
+    In a month without events the cursor points before its first event.
+
+    :param list_cmd: Event list command template with month and year
+    :param log: Logger instance
+    :param now: (Optional) Unix timestamp
+    :return: Cursor dict or None if the events can not be listed
+    """
+    if now is None:
+        now = time.time()
+    today = time.localtime(now)
+    events = _list_events(list_cmd, today.tm_year, today.tm_mon, log)
+    if events is None:
+        return None
+    return {'year': today.tm_year,
+            'month': today.tm_mon,
+            'eventid': events[-1][2] if events else '',
+            'updated': now}
+
+
+def _event_entries(list_cmd, fetch_cmd, cursor, source, download_list,
+                   save_path, log, now=None):
+    """
+    Turns the server events since the cursor into a download list.
+
+    Only paths below the download list entries are kept. Renamed files are
+    taken under their new path; when that can not be read from the event
+    a full comparison is needed.
+
+    :param list_cmd: Event list command template with month and year
+    :param fetch_cmd: Event save command template with month, year,
+                      event_id and save_path
+    :param cursor: Stored cursor dict
+    :param source: Source folder below home/
+    :param download_list: Download list entries limiting the events
+    :param save_path: Scratch folder for the saved event files
+    :param log: Logger instance
+    :param now: (Optional) Unix timestamp
+    :return: Tuple of entries and the new cursor; (None, None) when a full
+             comparison is needed
+    """
+    if now is None:
+        now = time.time()
+    if cursor is None or cursor.get('eventid') is None:
+        log.info("No server event cursor stored.")
+        return None, None
+    if now - cursor.get('updated', 0) > EVENT_CURSOR_MAX_AGE:
+        log.info("Server event cursor from {} is too old.".format(
+            cursor.get('updated')))
+        return None, None
+
+    entries = set()
+    new_cursor = dict(cursor, updated=now)
+    for year, month in _event_months(cursor['year'], cursor['month'], now):
+        events = _list_events(list_cmd, year, month, log)
+        if events is None:
+            return None, None
+
+        if (year, month) == (cursor['year'], cursor['month']) \
+                and cursor['eventid']:
+            event_ids = [event_id for _, _, event_id in events]
+            if cursor['eventid'] not in event_ids:
+                log.info("Server event {} is gone.".format(cursor['eventid']))
+                return None, None
+            events = events[event_ids.index(cursor['eventid']) + 1:]
+
+        for operation, _, event_id in events:
+            operation = operation.lower()
+            if not any(skip in operation for skip in EVENT_SKIP_OPERATIONS):
+                renamed = any(rename in operation
+                              for rename in EVENT_RENAME_OPERATIONS)
+                paths = _fetch_event_paths(fetch_cmd, year, month, event_id,
+                                           save_path, log, renamed=renamed)
+                if paths is None:
+                    return None, None
+                for path in paths:
+                    entry = _source_entry(path, source)
+                    if entry is not None \
+                            and _in_download_list(entry, download_list):
+                        entries.add(entry)
+            new_cursor.update(year=year, month=month, eventid=event_id)
+
+    return sorted(entries), new_cursor
+
+
 def _parse_args():
     """
     Parses command line arguments.
@@ -262,6 +1198,17 @@ def _parse_args():
                         help='Full file path to file download list.',
                         type=str,
                         required=True)
+    parser.add_argument('--staging-path',
+                        help='Fast scratch folder (tmpfs/SSD) to download '
+                             'into before moving files to the target path.',
+                        type=str)
+    parser.add_argument('--staging-budget',
+                        help='Bytes in the staging folder above which '
+                             'downloads wait for the mover (soft limit).',
+                        type=int)
+    parser.add_argument('--use-events',
+                        help='Download only the files of new server events.',
+                        action='store_true')
     args = parser.parse_args()
     return args
 
@@ -273,7 +1220,12 @@ def run_download(idrive_root=None,
                  pwd_file=None,
                  pvt_key=None,
                  files_from=None,
-                 log=None):
+                 log=None,
+                 staging_path=None,
+                 staging_budget=None,
+                 use_events=False,
+                 ledger=None,
+                 governor=None):
     """
     Download the files from cloud.
 
@@ -285,6 +1237,12 @@ def run_download(idrive_root=None,
     :param pvt_key:
     :param files_from:
     :param log:
+    :param staging_path: (Optional) Scratch folder to download into first
+    :param staging_budget: (Optional) Maximum bytes held in staging_path
+    :param use_events: (Optional) Download only the files of server events
+                       since the stored cursor
+    :param ledger: (Optional) Ledger recording the run and its files
+    :param governor: (Optional) Governor throttling the transfers under load
     :return:
     """
 
@@ -302,6 +1260,8 @@ def run_download(idrive_root=None,
         log = _create_logger(path='{}/log'.format(idrive_root))
 
     log.info("Starting download.")
+    run_id = ledger.start_run('download', user_name) \
+        if ledger is not None else None
 
     # Get IDrive server name
     ret, ret_code = _exec_cmd(cmd='{root}/bin/{bin_name} '
@@ -334,29 +1294,168 @@ def run_download(idrive_root=None,
 
         # Continue if there's no error
         if ret_code == 0:
-            # Now, as we have the server name, let's upload the files
-            ret, ret_code = _exec_cmd_flush(
+            tuner = TransferTuner(tuning_file(idrive_root, 'download',
+                                              user_name),
+                                  log=log,
+                                  batch_size=DOWNLOAD_BATCH_SIZE)
+            entries = _read_file_list(files_from)
+            chunked_entries = []
+            bw_option = '--bw-file={} '.format(governor.bw_file) \
+                if governor is not None else ''
+
+        if ret_code == 0 and use_events:
+            # Find the files added since the last run in the server events
+            cursor_file = _event_cursor_file(idrive_root, source)
+            list_cmd = ('{root}/bin/{bin_name} '
+                        '--password-file={password} '
+                        '--event-month={{month}} '
+                        '--event-year={{year}} '
+                        '{user}@{server}'
+                        ''.format(root=idrive_root,
+                                  bin_name=IDRIVE_BIN,
+                                  password=pwd_file,
+                                  user=user_name,
+                                  server=cmd_utility_server))
+            fetch_cmd = ('{root}/bin/{bin_name} '
+                         '--password-file={password} '
+                         '--event-month={{month}} '
+                         '--event-year={{year}} '
+                         '--eventid={{event_id}} '
+                         '--save-event={{save_path}} '
+                         '{user}@{server}'
+                         ''.format(root=idrive_root,
+                                   bin_name=IDRIVE_BIN,
+                                   password=pwd_file,
+                                   user=user_name,
+                                   server=cmd_utility_server))
+            event_entries, new_cursor = _event_entries(
+                list_cmd=list_cmd,
+                fetch_cmd=fetch_cmd,
+                cursor=_read_event_cursor(cursor_file),
+                source=source,
+                download_list=entries,
+                save_path=os.path.join(idrive_root, 'tmp', 'events'),
+                log=log)
+            if event_entries is None:
+                # Take the cursor before comparing, so events arriving
+                # meanwhile are picked up by the next run
+                log.info("Falling back to a full comparison.")
+                new_cursor = _latest_event_cursor(list_cmd, log)
+            else:
+                log.info("Found {} new files in the server "
+                         "events.".format(len(event_entries)))
+                entries = event_entries
+
+        if ret_code == 0:
+            # Files uploaded in chunks are rebuilt from their manifests,
+            # their chunks are only fetched when needed
+            chunked_entries = [entry for entry in entries
+                               if is_manifest_entry(entry)]
+            entries = [entry for entry in entries
+                       if not is_manifest_entry(entry)
+                       and not is_chunk_entry(entry)]
+
+        if ret_code == 0 and staging_path is not None:
+            # Download in batches to the scratch area and move the files
+            # into the target tree in the background
+            ret_code = _download_staged(
+                cmd='{root}/bin/{bin_name} '
+                    '--verbose '
+                    '--xml-output '
+                    '{bw_option}'
+                    '--password-file={password} '
+                    '--pvt-key={encryption_key} '
+                    '--temp={{temp}} '
+                    '--files-from={{file_list}} '
+                    '{user}@{server}::home/{path}/ '
+                    '{{target}}'
+                    ''.format(
+                        root=idrive_root,
+                        bin_name=IDRIVE_BIN,
+                        bw_option=bw_option,
+                        password=pwd_file,
+                        encryption_key=pvt_key,
+                        user=user_name,
+                        server=cmd_utility_server,
+                        path=source),
+                entries=entries,
+                staging_path=staging_path,
+                staging_budget=staging_budget,
+                target_path=target_path,
+                tuner=tuner,
+                log=log,
+                ledger=ledger,
+                run_id=run_id,
+                governor=governor)
+            log.info("Download finished.")
+        elif ret_code == 0:
+            # Now, as we have the server name, let's download the files
+            ret_code = _download_batches(
                 cmd='{root}/bin/{bin_name} '
                     '--verbose '
                     '--xml-output '
+                    '{bw_option}'
                     '--password-file={password} '
                     '--pvt-key={encryption_key} '
-                    '--files-from={file_list} '
+                    '--files-from={{file_list}} '
                     '{user}@{server}::home/{path}/ '
                     '{target}'
                     ''.format(
                         root=idrive_root,
                         bin_name=IDRIVE_BIN,
+                        bw_option=bw_option,
                         password=pwd_file,
                         encryption_key=pvt_key,
-                        file_list=files_from,
                         user=user_name,
                         server=cmd_utility_server,
                         path=source,
                         target=target_path),
-                log=log)
+                entries=entries,
+                list_path=os.path.join(idrive_root, 'tmp'),
+                tuner=tuner,
+                log=log,
+                ledger=ledger,
+                run_id=run_id,
+                governor=governor)
             log.info("Download finished.")
 
+        if cmd_utility_server is not None and chunked_entries:
+            chunk_rc = _download_chunked(
+                cmd='{root}/bin/{bin_name} '
+                    '--verbose '
+                    '--xml-output '
+                    '{bw_option}'
+                    '--password-file={password} '
+                    '--pvt-key={encryption_key} '
+                    '--files-from={{file_list}} '
+                    '{user}@{server}::home/{path}/ '
+                    '{{target}}'
+                    ''.format(
+                        root=idrive_root,
+                        bin_name=IDRIVE_BIN,
+                        bw_option=bw_option,
+                        password=pwd_file,
+                        encryption_key=pvt_key,
+                        user=user_name,
+                        server=cmd_utility_server,
+                        path=source),
+                manifest_entries=chunked_entries,
+                scratch_path=os.path.join(staging_path or
+                                          os.path.join(idrive_root, 'tmp'),
+                                          'chunks'),
+                target_path=target_path,
+                log=log,
+                staging_budget=staging_budget,
+                governor=governor)
+            if ret_code == 0:
+                ret_code = chunk_rc
+
+        if ret_code == 0 and use_events and new_cursor is not None:
+            _write_event_cursor(cursor_file, new_cursor)
+
+    if ledger is not None:
+        ledger.finish_run(run_id, ret_code)
+
     return ret_code
 
 
@@ -377,6 +1476,9 @@ if __name__ == "__main__":
         pwd_file = getattr(args, 'password_file')
         pvt_key = getattr(args, 'pvt_key')
         files_from = getattr(args, 'files_from')
+        staging_path = getattr(args, 'staging_path')
+        staging_budget = getattr(args, 'staging_budget')
+        use_events = getattr(args, 'use_events')
 
         # Run backup function
         log = _create_logger(path=os.path.dirname(__file__),
@@ -388,7 +1490,10 @@ if __name__ == "__main__":
                                 pwd_file=pwd_file,
                                 pvt_key=pvt_key,
                                 files_from=files_from,
-                                log=log)
+                                log=log,
+                                staging_path=staging_path,
+                                staging_budget=staging_budget,
+                                use_events=use_events)
         log.info("Run download command returned: {}".format(ret_code))
 
 
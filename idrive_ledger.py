@@ -0,0 +1,292 @@
+#!/ffp/bin/python
+
+"""
+Run history and per file transfer ledger.
+
+Run cmd:
+/ffp/bin/python idrive_ledger.py --db /ffp/idrive/cfg/ledger.db history /mnt/HD_a2/photo/IMG_0001.jpg
+/ffp/bin/python idrive_ledger.py --db /ffp/idrive/cfg/ledger.db trend --direction upload --days 30
+"""
+
+import time
+import sqlite3
+import argparse
+
+from idrive_transfer import parse_transfer_items, is_transferred
+
+__author__ = 'kpiwk'
+
+
+# Transfer rows buffered before they are written in one transaction
+LEDGER_BATCH_SIZE = 500
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    direction TEXT NOT NULL,
+    account TEXT,
+    started REAL NOT NULL,
+    finished REAL,
+    ret_code INTEGER,
+    files INTEGER,
+    bytes INTEGER,
+    in_sync INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS transfers (
+    id INTEGER PRIMARY KEY,
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    time REAL NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER,
+    status TEXT,
+    ret_code INTEGER
+);
+CREATE INDEX IF NOT EXISTS runs_started ON runs (started);
+CREATE INDEX IF NOT EXISTS transfers_path_time ON transfers (path, time);
+CREATE INDEX IF NOT EXISTS transfers_time ON transfers (time);
+CREATE INDEX IF NOT EXISTS transfers_run ON transfers (run_id);
+"""
+
+
+class Ledger(object):
+    """
+    SQLite ledger of backup/download runs and their file transfers.
+
+    Transfer rows are buffered and inserted in batches; the database runs in
+    WAL mode so queries from the command line do not block the daemon.
+    """
+
+    def __init__(self, db_path, batch_size=LEDGER_BATCH_SIZE):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self._pending = []
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(_SCHEMA)
+        if 'in_sync' not in [column[1] for column in self.conn.execute('PRAGMA table_info(runs)')]:
+            # Ledger created before the in sync counts
+            self.conn.execute('ALTER TABLE runs ADD COLUMN in_sync INTEGER NOT NULL DEFAULT 0')
+        self.conn.commit()
+
+    def start_run(self, direction, account=None):
+        """
+        Records the start of a run.
+
+        :param direction: 'upload' or 'download'
+        :param account: IDrive user name
+        :return: Run id
+        """
+        with self.conn:
+            cursor = self.conn.execute('INSERT INTO runs (direction, account, started) VALUES (?, ?, ?)',
+                                       (direction, account, time.time()))
+        return cursor.lastrowid
+
+    def add_transfer(self, run_id, path, size=None, status=None, ret_code=0, timestamp=None):
+        """
+        Buffers one file transfer event.
+
+        :param run_id: Run id from start_run
+        :param path: File path
+        :param size: File size in bytes
+        :param status: Transfer type (FULL, INCREMENTAL) or FAILED
+        :param ret_code: Return code of the idevsutil run
+        :param timestamp: (Optional) Unix timestamp, defaults to now
+        :return:
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        self._pending.append((run_id, timestamp, path, size, status, ret_code))
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def record_batch(self, run_id, output, ret_code, timestamp=None, sources=None):
+        """
+        Records the files of a finished transfer batch.
+
+        Transferred and failed files get a row; files in sync are only
+        counted on the run. The rows are written right away, so the
+        batches of a run killed halfway are kept.
+
+        :param run_id: Run id from start_run
+        :param output: idevsutil output of the batch
+        :param ret_code: Return code of the batch
+        :param timestamp: (Optional) Unix timestamp the batch ended, defaults to now
+        :param sources: (Optional) Dict of transferred name (without leading /) to the (path, size) recorded
+                        instead, e.g. for the manifests of chunked files
+        :return:
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        in_sync = 0
+        for item in parse_transfer_items(output):
+            if item.get('trf_type') == 'FILE IN SYNC':
+                in_sync += 1
+                continue
+            path = item['fname']
+            try:
+                size = int(float(item.get('size', 0)))
+            except ValueError:
+                size = None
+            if sources is not None and path.lstrip('/') in sources:
+                path, size = sources[path.lstrip('/')]
+            if is_transferred(item):
+                status = item.get('trf_type', 'FULL')
+            else:
+                status = 'FAILED'
+            self.add_transfer(run_id, path, size=size, status=status, ret_code=ret_code, timestamp=timestamp)
+        self.flush()
+        if in_sync:
+            with self.conn:
+                self.conn.execute('UPDATE runs SET in_sync = in_sync + ? WHERE id = ?', (in_sync, run_id))
+
+    def recorder(self, run_id):
+        """
+        Builds the after_batch callable of run_transfers recording into a run.
+
+        :param run_id: Run id from start_run
+        :return: Callable(batch_no, items, output, ret_code, finished)
+        """
+        def _record(batch_no, items, output, ret_code, finished):
+            self.record_batch(run_id, output, ret_code, timestamp=finished)
+
+        return _record
+
+    def flush(self):
+        """
+        Writes the buffered transfer rows.
+
+        :return:
+        """
+        if not self._pending:
+            return
+        with self.conn:
+            self.conn.executemany('INSERT INTO transfers (run_id, time, path, size, status, ret_code) '
+                                  'VALUES (?, ?, ?, ?, ?, ?)', self._pending)
+        self._pending = []
+
+    def finish_run(self, run_id, ret_code):
+        """
+        Records the end of a run with its transferred files and bytes.
+
+        :param run_id: Run id from start_run
+        :param ret_code: Return code of the run
+        :return:
+        """
+        self.flush()
+        with self.conn:
+            self.conn.execute("UPDATE runs SET finished = ?, ret_code = ?, "
+                              "files = (SELECT COUNT(*) FROM transfers "
+                              "         WHERE run_id = runs.id AND status IN ('FULL', 'INCREMENTAL')), "
+                              "bytes = (SELECT COALESCE(SUM(size), 0) FROM transfers "
+                              "         WHERE run_id = runs.id AND status IN ('FULL', 'INCREMENTAL')) "
+                              "WHERE id = ?", (time.time(), ret_code, run_id))
+
+    def purge(self, retention_days):
+        """
+        Deletes runs and transfers older than the retention period.
+
+        :param retention_days: Days of history to keep
+        :return: Number of deleted runs
+        """
+        self.flush()
+        cutoff = time.time() - retention_days * 86400
+        with self.conn:
+            self.conn.execute('DELETE FROM transfers WHERE run_id IN (SELECT id FROM runs WHERE started < ?)',
+                              (cutoff,))
+            cursor = self.conn.execute('DELETE FROM runs WHERE started < ?', (cutoff,))
+        return cursor.rowcount
+
+    def file_history(self, path, limit=20):
+        """
+        Lists the latest transfer events of a file.
+
+        :param path: File path; * matches any characters
+        :param limit: Maximum number of rows
+        :return: List of (time, direction, path, status, size, ret_code) rows, newest first
+        """
+        if '*' in path:
+            condition = 'transfers.path GLOB ?'
+        else:
+            condition = 'transfers.path = ?'
+        return self.conn.execute('SELECT transfers.time, runs.direction, transfers.path, transfers.status, '
+                                 '       transfers.size, transfers.ret_code '
+                                 'FROM transfers JOIN runs ON runs.id = transfers.run_id '
+                                 'WHERE {} ORDER BY transfers.time DESC LIMIT ?'.format(condition),
+                                 (path, limit)).fetchall()
+
+    def throughput(self, direction=None, days=30):
+        """
+        Sums the runs per day.
+
+        :param direction: (Optional) 'upload' or 'download'
+        :param days: Number of days to look back
+        :return: List of (day, runs, files, bytes, seconds) rows
+        """
+        query = ("SELECT date(started, 'unixepoch', 'localtime') AS day, COUNT(*), SUM(files), SUM(bytes), "
+                 "       SUM(finished - started) "
+                 "FROM runs WHERE finished IS NOT NULL AND started >= ? ")
+        params = [time.time() - days * 86400]
+        if direction is not None:
+            query += 'AND direction = ? '
+            params.append(direction)
+        query += 'GROUP BY day ORDER BY day'
+        return self.conn.execute(query, params).fetchall()
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+def _format_time(timestamp):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
+
+
+def _parse_args():
+    """
+    Parses command line arguments.
+
+    :return: Parsed arguments
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', help='Full path to the ledger database.', type=str, required=True)
+    commands = parser.add_subparsers(dest='command')
+
+    history = commands.add_parser('history', help='Show the transfer history of a file.')
+    history.add_argument('path', help='File path; * matches any characters.', type=str)
+    history.add_argument('--limit', help='Maximum number of rows.', type=int, default=20)
+
+    trend = commands.add_parser('trend', help='Show the daily throughput.')
+    trend.add_argument('--direction', help='upload or download.', choices=['upload', 'download'])
+    trend.add_argument('--days', help='Number of days to look back.', type=int, default=30)
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    def main():
+        """
+        This is the main function.
+
+        :return:
+        """
+
+        # Get all arguments
+        args = _parse_args()
+        ledger = Ledger(args.db)
+
+        if args.command == 'history':
+            for timestamp, direction, path, status, size, ret_code in ledger.file_history(args.path, args.limit):
+                print '{} {:8} {:12} {:>12} rc={} {}'.format(_format_time(timestamp), direction, status, size,
+                                                              ret_code, path)
+        elif args.command == 'trend':
+            for day, runs, files, num_bytes, seconds in ledger.throughput(args.direction, args.days):
+                rate = (num_bytes or 0) / seconds if seconds else 0
+                print '{} runs={} files={} bytes={} avg={:.0f} B/s'.format(day, runs, files or 0, num_bytes or 0,
+                                                                          rate)
+
+        ledger.close()
+
+
+    main()
@@ -0,0 +1,294 @@
+"""
+Transfer runner shared by uploads and downloads.
+
+Splits a transfer list into batches, runs several idevsutil processes at
+once and tunes the number of processes and the batch size from the
+throughput parsed out of the idevsutil xml output.
+"""
+
+import os
+import re
+import json
+import errno
+import time
+import threading
+from timeit import default_timer as timer
+
+__author__ = 'kpiwk'
+
+
+# Limits of the tuned settings
+MIN_CONCURRENCY = 1
+MAX_CONCURRENCY = 4
+MIN_BATCH_SIZE = 10
+MAX_BATCH_SIZE = 2000
+BATCH_SIZE_STEP = 50
+
+# Rounds shorter than this say little about the link and are not learned from
+MIN_SAMPLE_SECONDS = 5.0
+
+# Throughput drop (relative to the running average) treated as congestion
+DROP_TOLERANCE = 0.1
+
+# Weight of the newest sample in the running average
+RATE_SMOOTHING = 0.3
+
+_ITEM_RE = re.compile(r'<item\s+(.*?)/?>')
+_ATTR_RE = re.compile(r'(\w+)\s*=\s*"([^"]*)"')
+
+
+def parse_transfer_items(output):
+    """
+    Parses the per file items of the idevsutil --xml-output.
+
+    Only the last item of every file name is kept, which is the final
+    state of its transfer.
+
+    :param output: idevsutil output
+    :return: List of attribute dicts in output order
+    """
+    items = dict()
+    order = []
+    for match in _ITEM_RE.finditer(output or ''):
+        attrs = dict(_ATTR_RE.findall(match.group(1)))
+        fname = attrs.get('fname')
+        if not fname:
+            continue
+        if fname not in items:
+            order.append(fname)
+        items[fname] = attrs
+    return [items[fname] for fname in order]
+
+
+def is_transferred(item):
+    """
+    Checks whether a parsed item is a finished transfer of file data.
+
+    :param item: Attribute dict from parse_transfer_items
+    :return: True for completed FULL/INCREMENTAL transfers
+    """
+    return item.get('per') == '100%' and item.get('trf_type') != 'FILE IN SYNC'
+
+
+def transferred_bytes(output):
+    """
+    Sums the size of the files transferred according to idevsutil output.
+
+    :param output: idevsutil output
+    :return: Bytes transferred
+    """
+    total = 0
+    for item in parse_transfer_items(output):
+        if is_transferred(item):
+            try:
+                total += int(float(item.get('size', 0)))
+            except ValueError:
+                pass
+    return total
+
+
+def tuning_file(idrive_root, direction, account):
+    """
+    Builds the path of the file holding the learned settings.
+
+    :param idrive_root: IDrive root folder
+    :param direction: 'upload' or 'download'
+    :param account: IDrive user name
+    :return: Full path to the settings file
+    """
+    account = re.sub(r'[^A-Za-z0-9.-]', '_', account or 'default')
+    return os.path.join(idrive_root, 'cfg', 'tuning-{}-{}.json'.format(direction, account))
+
+
+class TransferTuner(object):
+    """
+    AIMD tuner for the number of concurrent idevsutil processes and the
+    number of files per batch.
+
+    One setting is tuned at a time. While the throughput of a round holds
+    up against the running average the setting grows additively; when it
+    drops (or a batch fails) the setting is halved and tuning moves on to
+    the other setting.
+    """
+
+    def __init__(self, state_file=None, log=None, concurrency=MIN_CONCURRENCY, batch_size=200):
+        self.state_file = state_file
+        self.log = log
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.knob = 'concurrency'
+        self.rate = None
+        self.load()
+
+    def load(self):
+        """
+        Reads the learned settings from the state file, if any.
+
+        :return:
+        """
+        if self.state_file is None:
+            return
+        try:
+            with open(self.state_file) as state:
+                settings = json.load(state)
+        except (IOError, ValueError):
+            return
+
+        self.concurrency = min(max(int(settings.get('concurrency', self.concurrency)), MIN_CONCURRENCY),
+                               MAX_CONCURRENCY)
+        self.batch_size = min(max(int(settings.get('batch_size', self.batch_size)), MIN_BATCH_SIZE),
+                              MAX_BATCH_SIZE)
+        self.knob = settings.get('knob', self.knob)
+        self.rate = settings.get('rate')
+
+    def save(self):
+        """
+        Writes the learned settings to the state file.
+
+        :return:
+        """
+        if self.state_file is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.state_file))
+        except OSError as exc:  # Python >2.5
+            if exc.errno != errno.EEXIST:
+                raise
+        with open(self.state_file + '.new', 'w') as state:
+            json.dump({'concurrency': self.concurrency,
+                       'batch_size': self.batch_size,
+                       'knob': self.knob,
+                       'rate': self.rate}, state)
+        os.rename(self.state_file + '.new', self.state_file)
+
+    def _increase(self):
+        if self.knob == 'concurrency':
+            if self.concurrency >= MAX_CONCURRENCY:
+                self.knob = 'batch_size'
+            else:
+                self.concurrency += 1
+                return
+        self.batch_size = min(self.batch_size + BATCH_SIZE_STEP, MAX_BATCH_SIZE)
+
+    def _decrease(self):
+        if self.knob == 'concurrency':
+            self.concurrency = max(self.concurrency // 2, MIN_CONCURRENCY)
+            self.knob = 'batch_size'
+        else:
+            self.batch_size = max(self.batch_size // 2, MIN_BATCH_SIZE)
+            self.knob = 'concurrency'
+
+    def record(self, num_bytes, seconds, failed=False):
+        """
+        Learns from a finished round of batches.
+
+        :param num_bytes: Bytes transferred in the round
+        :param seconds: Wall time of the round
+        :param failed: True if any batch of the round failed
+        :return:
+        """
+        if failed:
+            self._decrease()
+        elif seconds < MIN_SAMPLE_SECONDS or num_bytes == 0:
+            # Nothing to learn from; e.g. all files were in sync
+            return
+        else:
+            rate = num_bytes / seconds
+            if self.rate is None or rate >= self.rate * (1 - DROP_TOLERANCE):
+                self._increase()
+            else:
+                self._decrease()
+            if self.rate is None:
+                self.rate = rate
+            else:
+                self.rate = (1 - RATE_SMOOTHING) * self.rate + RATE_SMOOTHING * rate
+
+        if self.log is not None:
+            self.log.debug("Tuner: {} bytes in {:.1f} seconds, average rate {} B/s. "
+                           "Next round: {} processes, {} files per batch.".format(num_bytes, seconds, self.rate,
+                                                                                   self.concurrency,
+                                                                                   self.batch_size))
+        self.save()
+
+
+def list_taker(items):
+    """
+    Wraps an ordered list into a take callable for run_transfers.
+
+    :param items: Ordered transfer list
+    :return: Callable returning the next up to N items
+    """
+    position = [0]
+
+    def take(count):
+        batch = items[position[0]:position[0] + count]
+        position[0] += len(batch)
+        return batch
+
+    return take
+
+
+def run_transfers(take, run_batch, tuner, log, before_round=None, after_batch=None):
+    """
+    Runs a transfer list in rounds of concurrent batches.
+
+    Every round starts tuner.concurrency batches of tuner.batch_size items
+    each, waits for all of them and feeds the achieved throughput back to
+    the tuner.
+
+    :param take: Callable returning up to N next items; empty when exhausted
+    :param run_batch: Callable(batch_no, items) returning (output, ret_code)
+    :param tuner: TransferTuner instance
+    :param log: Logger instance
+    :param before_round: (Optional) Callable invoked before every round
+    :param after_batch: (Optional) Callable(batch_no, items, output, ret_code, finished) invoked in the
+                        calling thread for every batch of a round once the round is over; finished is the
+                        unix timestamp the batch ended
+    :return: List of (batch_no, items, output, ret_code) tuples
+    """
+    results = []
+    batch_no = 0
+    while True:
+        if before_round is not None:
+            before_round()
+
+        batches = []
+        for _ in range(tuner.concurrency):
+            items = take(tuner.batch_size)
+            if not items:
+                break
+            batch_no += 1
+            batches.append((batch_no, items))
+        if not batches:
+            break
+
+        round_results = [('', 1)] * len(batches)
+        finished = [None] * len(batches)
+
+        def _worker(index, worker_batch_no, worker_items):
+            try:
+                round_results[index] = run_batch(worker_batch_no, worker_items)
+            except Exception as exc:
+                log.error("Transfer batch {} failed: {}".format(worker_batch_no, exc))
+            finished[index] = time.time()
+
+        start = timer()
+        threads = []
+        for index, (worker_batch_no, worker_items) in enumerate(batches):
+            thread = threading.Thread(target=_worker, args=(index, worker_batch_no, worker_items))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        elapsed = timer() - start
+
+        round_bytes = sum(transferred_bytes(output) for output, _ in round_results)
+        failed = any(ret_code != 0 for _, ret_code in round_results)
+        tuner.record(round_bytes, elapsed, failed=failed)
+
+        for (worker_batch_no, worker_items), (output, ret_code), batch_end in zip(batches, round_results, finished):
+            results.append((worker_batch_no, worker_items, output, ret_code))
+            if after_batch is not None:
+                after_batch(worker_batch_no, worker_items, output, ret_code, batch_end)
+
+    return results
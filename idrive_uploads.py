@@ -9,6 +9,13 @@ __author__ = 'kpiwk'
 
 import os
 import sys
+import stat
+import math
+import time
+import heapq
+import fcntl
+import struct
+import threading
 from subprocess import Popen, PIPE
 import logging
 from logging.handlers import RotatingFileHandler
@@ -16,9 +23,41 @@ import argparse
 from xml.etree import ElementTree as et
 import errno
 
+from idrive_transfer import TransferTuner, run_transfers, tuning_file
+from idrive_chunks import ChunkIndex, chunk_file, chunk_entry, write_manifest, clear_outbox
+
 
 DEBUG = True
 
+# Number of files submitted to one idevsutil run until the tuner learned better
+UPLOAD_BATCH_SIZE = 200
+
+# Pipelined uploads: changes held in the priority queue between the scanner
+# and the uploader, and the bytes/seconds after which a partial batch is
+# flushed to idevsutil
+PIPELINE_QUEUE_SIZE = 10000
+PIPELINE_FLUSH_BYTES = 256 * 1024 * 1024
+PIPELINE_FLUSH_SECONDS = 10.0
+
+# Chunked uploads: new chunk bytes written to the outbox before they are uploaded
+CHUNK_ROUND_BYTES = 256 * 1024 * 1024
+
+# Files whose priority scores lie within a factor of PRIORITY_TIER_BASE share a
+# tier; the files of a tier are uploaded in disk order
+PRIORITY_TIER_BASE = 2.0
+
+# ioctl numbers from linux/fs.h; passed as signed int for Python 2
+FS_IOC_FIEMAP = struct.unpack('i', struct.pack('I', 0xC020660B))[0]
+FIBMAP = 1
+
+# fe_flags of extents without a physical location yet (unknown, delayed allocation)
+FIEMAP_EXTENT_UNKNOWN = 0x2
+FIEMAP_EXTENT_DELALLOC = 0x4
+
+# struct fiemap header and struct fiemap_extent
+_FIEMAP_HEADER = struct.Struct('=QQLLLL')
+_FIEMAP_EXTENT = struct.Struct('=QQQQQLLLL')
+
 
 def _create_logger(path=None, filename=None):
     if path is not None:
@@ -88,34 +127,47 @@ def _exec_cmd(cmd=None, usr_input=None, log=None, debug=DEBUG):
     return ret, proc.returncode
 
 
-def _exec_cmd_flush(cmd=None, usr_input=None, log=None, debug=DEBUG):
+def _exec_cmd_flush(cmd=None, usr_input=None, log=None, debug=DEBUG, governor=None):
     """
     Executes a command line command.
 
     :param cmd: Command to execute
     :param usr_input: (Optional) Input to pass to the executed command
     :param debug: Enables debug logging if True
+    :param governor: (Optional) Governor throttling the command under load
     :return:
     """
 
     if log is None:
         log = _create_logger(path='{}/log'.format(os.path.join(os.path.dirname(__file__), '..')))
 
+    if governor is not None:
+        # Run governed commands in their own process group, so they can be stopped as a whole. The shell
+        # execs setsid, which is no group leader then and execs the command in place: proc.pid leads the group.
+        cmd = ' '.join(part for part in ('exec setsid', governor.command_prefix, cmd) if part)
+
     if debug:
         log.debug("Executing command: {0}".format(cmd))
 
     proc = Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE, stdin=PIPE)
+    if governor is not None:
+        governor.register(proc)
 
     # Poll process for new output until finished
+    lines = []
     while True:
         next_line = proc.stdout.readline()
         if next_line == '' and proc.poll() is not None:
             break
         # sys.stdout.write(next_line)
         # sys.stdout.flush()
-        log.debug(next_line)
+        if next_line:
+            lines.append(next_line)
+            log.debug(next_line)
 
     ret, err = proc.communicate(input=usr_input)
+    if governor is not None:
+        governor.unregister(proc)
 
     if debug:
         if ret:
@@ -125,7 +177,7 @@ def _exec_cmd_flush(cmd=None, usr_input=None, log=None, debug=DEBUG):
 
     #assert proc.returncode == 0, 'Aborting. Return code: {0}'.format(proc.returncode)
 
-    return ret, proc.returncode
+    return ''.join(lines) + (ret or ''), proc.returncode
 
 
 def _flush_print(text=None, sub=None):
@@ -137,6 +189,572 @@ def _flush_print(text=None, sub=None):
     sys.stdout.flush()
 
 
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as exc:  # Python >2.5
+        if exc.errno == errno.EEXIST and os.path.isdir(path):
+            pass
+        else:
+            raise
+
+
+def _read_file_list(files_from):
+    """
+    Reads a files-from list.
+
+    :param files_from: Full path to the list file
+    :return: List of non-empty entries
+    """
+    with open(files_from) as list_file:
+        return [line.rstrip('\n') for line in list_file if line.strip()]
+
+
+def _write_file_list(files_from, entries, from0=False):
+    """
+    Writes a files-from list.
+
+    :param files_from: Full path to the list file
+    :param entries: List entries
+    :param from0: Delimit the entries by NUL for idevsutil --from0
+    :return:
+    """
+    delimiter = '\0' if from0 else '\n'
+    with open(files_from, 'w') as list_file:
+        for entry in entries:
+            list_file.write(entry + delimiter)
+
+
+def _first_block(path):
+    """
+    Finds the physical location of the start of a file.
+
+    Uses FIEMAP and falls back to FIBMAP, which needs root. Data not yet
+    written back has no physical location; such files count as unknown.
+
+    :param path: Full path of the file
+    :return: Physical byte offset or None if unknown
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        request = _FIEMAP_HEADER.pack(0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0) + b'\0' * _FIEMAP_EXTENT.size
+        try:
+            response = fcntl.ioctl(fd, FS_IOC_FIEMAP, request)
+            if _FIEMAP_HEADER.unpack_from(response)[3]:
+                extent = _FIEMAP_EXTENT.unpack_from(response, _FIEMAP_HEADER.size)
+                if extent[5] & (FIEMAP_EXTENT_UNKNOWN | FIEMAP_EXTENT_DELALLOC) or not extent[1]:
+                    return None
+                return extent[1]
+            # No extents: empty or inline file
+            return None
+        except IOError:
+            pass
+        try:
+            block = struct.unpack('i', fcntl.ioctl(fd, FIBMAP, struct.pack('i', 0)))[0]
+            if block:
+                return block * os.fstat(fd).st_blksize
+        except IOError:
+            pass
+        return None
+    finally:
+        os.close(fd)
+
+
+def _locality_key(path):
+    """
+    Sort key placing files in their on-disk order.
+
+    Files are grouped by device and ordered by their first physical block
+    where it can be read, by inode number otherwise and by path last.
+
+    :param path: Full path of the file
+    :return: Sort key
+    """
+    try:
+        path_stat = os.lstat(path)
+    except OSError:
+        return 0, 2, 0, path
+    block = _first_block(path)
+    if block is not None:
+        return path_stat.st_dev, 0, block, path
+    return path_stat.st_dev, 1, path_stat.st_ino, path
+
+
+def _read_last_upload(state_file):
+    """
+    Reads the start time of the last fully successful backup cycle.
+
+    :param state_file: Full path to the state file
+    :return: Unix timestamp or None if unknown
+    """
+    try:
+        with open(state_file) as state:
+            return float(state.read().strip())
+    except (IOError, ValueError):
+        return None
+
+
+def _write_last_upload(state_file, timestamp):
+    _makedirs(os.path.dirname(state_file))
+    with open(state_file + '.new', 'w') as state:
+        state.write('{:.6f}\n'.format(timestamp))
+    os.rename(state_file + '.new', state_file)
+
+
+def _scan_backup_roots(roots, since=None):
+    """
+    Walks the backup roots and yields files changed since the given time.
+
+    The change time is taken into account as well, so files moved into a
+    backup root with an old modification time are still picked up.
+
+    :param roots: Backup list entries (files or folders)
+    :param since: (Optional) Unix timestamp; all files are yielded if None
+    :return: Generator of (path, size, mtime, root) tuples
+    """
+    for root in roots:
+        # Backup list entries are relative to the / upload source
+        root_path = os.path.join('/', root)
+        if os.path.isfile(root_path):
+            candidates = [(os.path.dirname(root_path), [], [os.path.basename(root_path)])]
+        else:
+            candidates = os.walk(root_path)
+        for dir_path, _, file_names in candidates:
+            for file_name in file_names:
+                path = os.path.join(dir_path, file_name)
+                try:
+                    path_stat = os.lstat(path)
+                except OSError:
+                    continue
+                if not stat.S_ISREG(path_stat.st_mode):
+                    continue
+                if since is None or max(path_stat.st_mtime, path_stat.st_ctime) >= since:
+                    yield path, path_stat.st_size, path_stat.st_mtime, root
+
+
+def _upload_priority(size, mtime, weight, now):
+    """
+    Scores a file for the upload queue. Lower scores are uploaded first.
+
+    The score grows with the age of the change (in hours) and the size
+    (in MB), so fresh small files go before old or big ones, and is divided
+    by the weight of the backup root the file belongs to.
+
+    :param size: File size in bytes
+    :param mtime: Modification time
+    :param weight: Weight of the backup root
+    :param now: Current unix timestamp
+    :return: Priority score
+    """
+    age = max(now - mtime, 0)
+    return (1 + age / 3600.0) * (1 + size / 1048576.0) / weight
+
+
+def _build_upload_queue(files, weights=None, now=None):
+    """
+    Builds the priority queue of files to upload.
+
+    :param files: Iterable of (path, size, mtime, root) tuples
+    :param weights: (Optional) Dict of backup root to weight, default 1
+    :param now: (Optional) Current unix timestamp
+    :return: Heap of (rank, path, size, mtime) tuples
+    """
+    if weights is None:
+        weights = {}
+    if now is None:
+        now = time.time()
+
+    upload_queue = []
+    for changed in files:
+        heapq.heappush(upload_queue, _queue_item(changed, weights, now))
+    return upload_queue
+
+
+def _queue_item(changed, weights, now):
+    """
+    Ranks a change for the upload queue.
+
+    Changes are ranked by their priority tier and by their disk location
+    within a tier, so consecutive batches read consecutive disk areas.
+    The order within a batch does not matter: idevsutil sorts its file
+    list by path.
+
+    :param changed: (path, size, mtime, root) tuple
+    :param weights: Dict of backup root to weight
+    :param now: Current unix timestamp
+    :return: (rank, path, size, mtime) tuple
+    """
+    path, size, mtime, root = changed
+    weight = float(weights.get(root, 1)) or 1.0
+    tier = int(math.floor(math.log(_upload_priority(size, mtime, weight, now), PRIORITY_TIER_BASE)))
+    return (tier, _locality_key(path)), path, size, mtime
+
+
+def _pop_batch(upload_queue, batch_size):
+    batch = []
+    while upload_queue and len(batch) < batch_size:
+        batch.append(heapq.heappop(upload_queue))
+    return batch
+
+
+def _upload_queue(cmd, take, list_path, tuner, log, ledger=None, run_id=None, governor=None, before_round=None):
+    """
+    Submits the upload queue to idevsutil in priority ordered batches.
+
+    The number of concurrent idevsutil runs and the batch size are taken
+    from the tuner.
+
+    :param cmd: Upload command template with a file_list placeholder
+    :param take: Callable returning the next up to N (rank, path, size, mtime) tuples
+    :param list_path: Folder for the per batch file lists
+    :param tuner: TransferTuner instance
+    :param log: Logger instance
+    :param ledger: (Optional) Ledger recording the transferred files
+    :param run_id: Ledger run id
+    :param governor: (Optional) Governor throttling the transfers under load
+    :param before_round: (Optional) Callable invoked before every round of batches
+    :return: Tuple of return code, longest time in seconds a queued change went unprotected and time the first
+             batch started
+    """
+    _makedirs(list_path)
+    first_upload = []
+    exposure = [0.0]
+    record = ledger.recorder(run_id) if ledger is not None else None
+
+    def _after_batch(batch_no, batch, output, batch_rc, finished):
+        if batch_rc == 0:
+            # The oldest change of the batch was unprotected until the batch finished
+            exposure[0] = max(exposure[0], finished - min(mtime for _, _, _, mtime in batch))
+        if record is not None:
+            record(batch_no, batch, output, batch_rc, finished)
+
+    def _run_batch(batch_no, batch):
+        if not first_upload:
+            first_upload.append(time.time())
+        batch_list = os.path.join(list_path, 'upload-batch-{:05d}'.format(batch_no))
+        _write_file_list(batch_list, [path for _, path, _, _ in batch], from0=True)
+
+        log.debug("Uploading batch {} with {} files ({} bytes).".format(
+            batch_no, len(batch), sum(size for _, _, size, _ in batch)))
+        output, batch_rc = _exec_cmd_flush(cmd=cmd.format(file_list=batch_list), log=log, governor=governor)
+        os.remove(batch_list)
+        return output, batch_rc
+
+    results = run_transfers(take=take, run_batch=_run_batch, tuner=tuner, log=log, before_round=before_round,
+                            after_batch=_after_batch)
+
+    ret_code = 0
+    for batch_no, batch, _, batch_rc in results:
+        if batch_rc != 0:
+            log.error("Upload batch {} failed. Return code was: {}".format(batch_no, batch_rc))
+            if ret_code == 0:
+                ret_code = batch_rc
+            # Still unprotected
+            exposure[0] = max(exposure[0], time.time() - min(mtime for _, _, _, mtime in batch))
+
+    return ret_code, exposure[0], min(first_upload) if first_upload else None
+
+
+class _ScanQueue(object):
+    """
+    Bounded priority queue between the scanner thread and the uploader.
+
+    The scanner pushes changes as it finds them and waits while the queue
+    is full. The uploader pops the most urgent changes scanned so far, so
+    they are ranked as in the sequential mode, except against files not
+    yet scanned. The first batch of a round waits until the queue holds
+    the requested number of files or max_bytes, or max_wait seconds passed
+    since a file was queued; the other batches of the round only take what
+    is queued already, so a slow scan does not hold back a round that
+    could start.
+    """
+
+    def __init__(self, weights=None, now=None, maxsize=PIPELINE_QUEUE_SIZE, max_bytes=PIPELINE_FLUSH_BYTES,
+                 max_wait=PIPELINE_FLUSH_SECONDS):
+        self.weights = weights if weights is not None else {}
+        self.now = now if now is not None else time.time()
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.max_wait = max_wait
+        self.queued = 0
+        self.scanned = False
+        self.closed = False
+        self._heap = []
+        self._bytes = 0
+        self._first = True
+        self._cond = threading.Condition()
+
+    def put(self, changed):
+        """
+        Queues a change; waits while the queue is full.
+
+        :param changed: (path, size, mtime, root) tuple
+        :return: False once the uploader closed the queue, True otherwise
+        """
+        with self._cond:
+            while len(self._heap) >= self.maxsize and not self.closed:
+                self._cond.wait()
+            if self.closed:
+                return False
+            heapq.heappush(self._heap, _queue_item(changed, self.weights, self.now))
+            self._bytes += changed[1]
+            self.queued += 1
+            self._cond.notify_all()
+            return True
+
+    def finish(self):
+        """
+        Marks the scan as complete.
+
+        :return:
+        """
+        with self._cond:
+            self.scanned = True
+            self._cond.notify_all()
+
+    def close(self):
+        """
+        Releases the scanner once the uploader is done, also when it failed.
+
+        :return:
+        """
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def before_round(self):
+        self._first = True
+
+    def take(self, count):
+        """
+        Pops the next batch for run_transfers.
+
+        :param count: Maximum number of files
+        :return: List of (rank, path, size, mtime) tuples; empty once the scan is over and the queue drained
+        """
+        with self._cond:
+            if self._first:
+                deadline = None
+                while not self.scanned and len(self._heap) < count and self._bytes < self.max_bytes:
+                    if self._heap and deadline is None:
+                        deadline = time.time() + self.max_wait
+                    timeout = None if deadline is None else deadline - time.time()
+                    if timeout is not None and timeout <= 0:
+                        break
+                    self._cond.wait(timeout)
+            self._first = False
+            batch = _pop_batch(self._heap, count)
+            self._bytes -= sum(size for _, _, size, _ in batch)
+            self._cond.notify_all()
+            return batch
+
+
+def _scan_producer(files, changes, large_files, chunk_threshold, scan):
+    """
+    Feeds scanned changes to the uploader; runs in its own thread.
+
+    Files of chunk_threshold bytes or more are set aside for the chunked
+    upload. The scan is marked complete at the end, also when it failed.
+
+    :param files: Iterable of (path, size, mtime, root) tuples, e.g. from _scan_backup_roots
+    :param changes: _ScanQueue read by the uploader
+    :param large_files: List collecting the files to upload in chunks
+    :param chunk_threshold: File size from which files are uploaded in chunks, or None
+    :param scan: Dict receiving the scan error, if any
+    :return:
+    """
+    try:
+        for changed in files:
+            if chunk_threshold is not None and changed[1] >= chunk_threshold:
+                large_files.append(changed)
+            elif not changes.put(changed):
+                # The uploader gave up
+                break
+    except Exception as exc:
+        scan['error'] = exc
+    finally:
+        changes.finish()
+
+
+def _upload_changes(cmd, files, list_path, tuner, log, weights=None, chunk_threshold=None, pipeline=False,
+                    ledger=None, run_id=None, governor=None, now=None):
+    """
+    Uploads scanned changes in priority ordered batches.
+
+    Without pipeline the scan completes and all changes are ranked before
+    the first batch starts. With pipeline a scanner thread feeds a bounded
+    priority queue and batches are flushed to idevsutil while the scan is
+    still running; changes are then ranked against those scanned so far.
+
+    :param cmd: Upload command template with a file_list placeholder
+    :param files: Iterable of (path, size, mtime, root) tuples, e.g. from _scan_backup_roots
+    :param list_path: Folder for the per batch file lists
+    :param tuner: TransferTuner instance
+    :param log: Logger instance
+    :param weights: (Optional) Dict of backup root to priority weight
+    :param chunk_threshold: (Optional) File size from which files are set aside for the chunked upload
+    :param pipeline: Overlap the scan with the uploads
+    :param ledger: (Optional) Ledger recording the transferred files
+    :param run_id: Ledger run id
+    :param governor: (Optional) Governor throttling the transfers under load
+    :param now: (Optional) Current unix timestamp for the priority scores
+    :return: Tuple of return code, longest time in seconds a change went unprotected, list of the files set aside
+             for the chunked upload and time the first batch started (None if nothing was uploaded)
+    """
+    large_files = []
+    if not pipeline:
+        small_files = []
+        for changed in files:
+            if chunk_threshold is not None and changed[1] >= chunk_threshold:
+                large_files.append(changed)
+            else:
+                small_files.append(changed)
+        upload_queue = _build_upload_queue(small_files, weights=weights, now=now)
+        log.info("Queued {} changed files.".format(len(upload_queue)))
+        ret_code, exposure, first_upload = _upload_queue(
+            cmd=cmd, take=lambda count: _pop_batch(upload_queue, count), list_path=list_path, tuner=tuner,
+            log=log, ledger=ledger, run_id=run_id, governor=governor)
+        return ret_code, exposure, large_files, first_upload
+
+    changes = _ScanQueue(weights=weights, now=now)
+    scan = {'error': None}
+    scanner = threading.Thread(target=_scan_producer, args=(files, changes, large_files, chunk_threshold, scan))
+    scanner.daemon = True
+    scanner.start()
+
+    try:
+        ret_code, exposure, first_upload = _upload_queue(
+            cmd=cmd, take=changes.take, list_path=list_path, tuner=tuner, log=log, ledger=ledger, run_id=run_id,
+            governor=governor, before_round=changes.before_round)
+    finally:
+        changes.close()
+        scanner.join()
+
+    log.info("Queued {} changed files while scanning.".format(changes.queued))
+    if scan['error'] is not None:
+        # Changes after the failure point were not seen; keep them for the next cycle
+        log.error("Scanning the backup roots failed: {}".format(scan['error']))
+        if ret_code == 0:
+            ret_code = 1
+    return ret_code, exposure, large_files, first_upload
+
+
+def _upload_chunked(cmd, files, chunk_root, index_path, list_path, log, ledger=None, run_id=None, governor=None,
+                    round_bytes=CHUNK_ROUND_BYTES):
+    """
+    Uploads large files as content defined chunks.
+
+    Only the chunks missing in the local chunk index are written to the
+    chunk root. They are uploaded in rounds whenever round_bytes of them
+    are waiting, also in the middle of a file, so the chunk root never
+    holds much more than that. Every round adds its chunks to the index,
+    clears the chunk root and uploads the manifests of the files whose
+    chunks are all on the server. The ledger records the source files with
+    the bytes of their new chunks, not the chunks themselves.
+
+    :param cmd: Upload command template with a file_list placeholder, uploading from chunk_root
+    :param files: List of (path, size, mtime, root) tuples
+    :param chunk_root: Local folder mirroring the server chunk folder
+    :param index_path: Full path to the chunk index database
+    :param list_path: Folder for the file lists
+    :param log: Logger instance
+    :param ledger: (Optional) Ledger recording the transferred files
+    :param run_id: Ledger run id
+    :param governor: (Optional) Governor throttling the transfers under load
+    :param round_bytes: New chunk bytes uploaded per round
+    :return: Tuple of return code and longest time in seconds a file went unprotected
+    """
+    _makedirs(list_path)
+    index = ChunkIndex(index_path)
+    # Chunks in the chunk root and files chunked completely, waiting for their manifest upload
+    outbox = dict()
+    chunked = []
+    counted = set()
+    state = {'ret_code': 0, 'exposure': 0.0, 'chunks': 0, 'bytes': 0}
+
+    def _upload(kind, entries):
+        batch_list = os.path.join(list_path, 'upload-{}'.format(kind))
+        _write_file_list(batch_list, entries, from0=True)
+        output, batch_rc = _exec_cmd_flush(cmd=cmd.format(file_list=batch_list), log=log, governor=governor)
+        os.remove(batch_list)
+        if batch_rc != 0:
+            log.error("Upload of {} failed. Return code was: {}".format(kind, batch_rc))
+        return output, batch_rc
+
+    def _upload_round():
+        if outbox:
+            _, batch_rc = _upload('chunks', sorted(chunk_entry(digest) for digest in outbox))
+            if batch_rc != 0:
+                if ledger is not None:
+                    for _, path, _, _ in chunked:
+                        ledger.add_transfer(run_id, path, status='FAILED', ret_code=batch_rc)
+                    ledger.flush()
+                return batch_rc
+            index.add(outbox.items())
+            state['chunks'] += len(outbox)
+            state['bytes'] += sum(outbox.values())
+            for digest in outbox:
+                os.remove(os.path.join(chunk_root, chunk_entry(digest).lstrip('/')))
+            outbox.clear()
+        if chunked:
+            output, batch_rc = _upload('manifests', [entry for entry, _, _, _ in chunked])
+            if ledger is not None:
+                ledger.record_batch(run_id, output, batch_rc,
+                                    sources=dict((entry.lstrip('/'), (path, new_bytes))
+                                                 for entry, path, new_bytes, _ in chunked))
+            if batch_rc != 0:
+                return batch_rc
+            for _, _, _, mtime in chunked:
+                state['exposure'] = max(state['exposure'], time.time() - mtime)
+            del chunked[:]
+        return 0
+
+    def _written(digest, size):
+        outbox[digest] = size
+        if sum(outbox.values()) >= round_bytes:
+            round_rc = _upload_round()
+            if round_rc != 0:
+                state['ret_code'] = round_rc
+                raise IOError("Chunk upload failed. Return code was: {}".format(round_rc))
+
+    unprotected = []
+    try:
+        for position, (path, size, mtime, _) in enumerate(files):
+            try:
+                manifest, file_chunks = chunk_file(path, index, chunk_root, written=_written)
+            except (IOError, OSError) as exc:
+                if state['ret_code'] != 0:
+                    if ledger is not None:
+                        ledger.add_transfer(run_id, path, status='FAILED', ret_code=state['ret_code'])
+                        ledger.flush()
+                    unprotected.extend(mtime for _, _, _, mtime in chunked)
+                    unprotected.extend(mtime for _, _, mtime, _ in files[position:])
+                    break
+                log.error("Unable to chunk {}: {}".format(path, exc))
+                unprotected.append(mtime)
+                continue
+            # Chunks shared with an earlier file of this run count for that file
+            chunked.append((write_manifest(chunk_root, manifest), path,
+                            sum(chunk_size for digest, chunk_size in file_chunks.items() if digest not in counted),
+                            mtime))
+            counted.update(file_chunks)
+        else:
+            state['ret_code'] = _upload_round() or (1 if unprotected else 0)
+            unprotected.extend(mtime for _, _, _, mtime in chunked)
+    finally:
+        clear_outbox(chunk_root)
+        index.close()
+
+    log.info("Chunked {} large files ({} bytes): uploaded {} new chunks with {} bytes.".format(
+        len(files), sum(size for _, size, _, _ in files), state['chunks'], state['bytes']))
+    for mtime in unprotected:
+        state['exposure'] = max(state['exposure'], time.time() - mtime)
+    return state['ret_code'], state['exposure']
+
+
 def _parse_args():
     """
     Parses command line arguments.
@@ -201,18 +819,32 @@ def _parse_args():
     parser.add_argument('--user', help='The name of the user. Most likely an email address.', type=str, required=True)
     parser.add_argument('--pvt-key', help='Full path to encryption key file.', type=str, required=True)
     parser.add_argument('--files-from', help='Full file path to backup sources list.', type=str, required=True)
+    parser.add_argument('--pipeline', help='Start uploading while the backup sources are still scanned.',
+                        action='store_true')
     args = parser.parse_args()
     return args
 
 
-def run_backup(idrive_root=None, destination=None, user_name=None, pwd_file=None, pvt_key=None, files_from=None, log=None):
+def run_backup(idrive_root=None, destination=None, user_name=None, pwd_file=None, pvt_key=None, files_from=None, log=None,
+               weights=None, ledger=None, chunk_threshold=None, governor=None, pipeline=False):
     """
     Runs the actual backup command.
 
+    Files of the backup roots changed since the last successful cycle are
+    queued by priority (recent, small and heavily weighted first) and
+    uploaded in batches. Files of chunk_threshold bytes or more are
+    uploaded as content defined chunks instead. With pipeline the batches
+    start while the backup roots are still being scanned.
+
     :param user_name:
     :param pwd_file:
     :param pvt_key:
     :param files_from:
+    :param weights: (Optional) Dict of backup root to priority weight
+    :param ledger: (Optional) Ledger recording the run and its files
+    :param chunk_threshold: (Optional) File size from which files are uploaded in chunks
+    :param governor: (Optional) Governor throttling the transfers under load
+    :param pipeline: Upload changes while scanning instead of after the scan
     :return:
     """
 
@@ -226,6 +858,9 @@ def run_backup(idrive_root=None, destination=None, user_name=None, pwd_file=None
         log = _create_logger(path='{}/log'.format(idrive_root))
 
     log.info("Starting backup.")
+    cycle_start = time.time()
+    state_file = os.path.join(idrive_root, 'cfg', 'last_upload')
+    run_id = ledger.start_run('upload', user_name) if ledger is not None else None
 
     # Get IDrive server name
     ret, ret_code = _exec_cmd(cmd='{}/bin/idevsutil --getServerAddress {} --password-file={}'.format(idrive_root, user_name, pwd_file), log=log)
@@ -249,11 +884,48 @@ def run_backup(idrive_root=None, destination=None, user_name=None, pwd_file=None
 
         # Continue if there's no error
         if ret_code == 0:
+            # Queue the files changed since the last successful backup
+            since = _read_last_upload(state_file)
+            log.info("Scanning for files changed since {}.".format(since))
+            scan_start = time.time()
+
+            bw_option = '--bw-file={} '.format(governor.bw_file) if governor is not None else ''
+
             # Now, as we have the server name, let's upload the files
             # ./idevsutil --xml-output --password-file=/ffp/idrive/acc_pwd --pvt-key=/ffp/idrive/enc_key --files-from=/ffp/idrive/backup_list / 'pivul@o2.pl'@$IDRIVESERVERNAME::home/
-            ret, ret_code = _exec_cmd_flush(cmd='{}/bin/idevsutil --verbose --xml-output --password-file={} --pvt-key={} --files-from={} / {}@{}::home/{}/'.format(idrive_root, pwd_file, pvt_key, files_from, user_name, cmd_utility_server, destination), log=log)
+            ret_code, exposure, large_files, first_upload = _upload_changes(
+                cmd='{}/bin/idevsutil --verbose --xml-output {}--password-file={} --pvt-key={} --from0 --files-from={{file_list}} / {}@{}::home/{}/'.format(idrive_root, bw_option, pwd_file, pvt_key, user_name, cmd_utility_server, destination),
+                files=_scan_backup_roots(_read_file_list(files_from), since), list_path=os.path.join(idrive_root, 'tmp'),
+                tuner=TransferTuner(tuning_file(idrive_root, 'upload', user_name), log=log,
+                                    batch_size=UPLOAD_BATCH_SIZE),
+                log=log, weights=weights, chunk_threshold=chunk_threshold, pipeline=pipeline, ledger=ledger,
+                run_id=run_id, governor=governor, now=cycle_start)
+            if first_upload is not None:
+                log.info("[Metric] Time to first upload: {:.1f} seconds".format(first_upload - scan_start))
+
+            if large_files:
+                chunk_root = os.path.join(idrive_root, 'chunks')
+                chunk_rc, chunk_exposure = _upload_chunked(
+                    cmd='{}/bin/idevsutil --verbose --xml-output {}--password-file={} --pvt-key={} --from0 --files-from={{file_list}} {}/ {}@{}::home/{}/'.format(idrive_root, bw_option, pwd_file, pvt_key, chunk_root, user_name, cmd_utility_server, destination),
+                    files=large_files, chunk_root=chunk_root, index_path=os.path.join(idrive_root, 'cfg', 'chunks.db'),
+                    list_path=os.path.join(idrive_root, 'tmp'), log=log, ledger=ledger, run_id=run_id,
+                    governor=governor)
+                if ret_code == 0:
+                    ret_code = chunk_rc
+                exposure = max(exposure, chunk_exposure)
+
+            # Age a change reached before its batch finished, or by now if it is still not uploaded
+            log.info("[Metric] Oldest unprotected file age: {:.0f} seconds".format(exposure))
+
+            log.info("[Metric] Upload cycle time: {:.1f} seconds".format(time.time() - scan_start))
+
+            if ret_code == 0:
+                _write_last_upload(state_file, cycle_start)
             log.info("Backup finished.")
 
+    if ledger is not None:
+        ledger.finish_run(run_id, ret_code)
+
     return ret_code
 
 
@@ -279,7 +951,7 @@ if __name__ == "__main__":
         ret_code = run_backup(idrive_root='/ffp/idrive',
                               destination=destination, user_name=user_name,
                               pwd_file=pwd_file, pvt_key=pvt_key,
-                              files_from=files_from, log=log)
+                              files_from=files_from, log=log, pipeline=args.pipeline)
         log.info("Run backup command returned: {}".format(ret_code))
 
 